@@ -0,0 +1,261 @@
+import argparse
+import csv
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+import zipfile
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from utils import (
+    ConnectionPool, DELIVERY_SCHEMAS, SYSTEM_OUTPUT_COLUMNS, consolidate_data, delivery_output_columns,
+    export_consolidated, id_match_columns, process_delivery, run_system_query
+)
+
+# Deliverys simulados: id do delivery no sistema, forma de pagamento e se a planilha sai com
+# os estilos quebrados que fazem o openpyxl falhar (TypeError no Fill)
+BENCH_DELIVERIES = {
+    "ifood":        {"id_delivery": 1032, "id_forma": 17, "broken_styles": False},
+    "mais_delivery": {"id_delivery": 1035, "id_forma": 18, "broken_styles": False},
+    "mais_delivery_estilos_quebrados": {"id_delivery": 1035, "id_forma": 18, "broken_styles": True},
+    "aiquefome":    {"id_delivery": 1231, "id_forma": 37, "broken_styles": False},
+    "goomer":       {"id_delivery": 709,  "id_forma": 1,  "broken_styles": False},
+}
+
+BENCH_EMPRESA = 58
+
+
+def generate_orders(n, seed=0, start=datetime(2025, 1, 1), days=30):
+    """Pedidos sintéticos: número, data/hora e valor, com muitos valores repetidos no mesmo dia."""
+    rng = np.random.default_rng(seed)
+    moments = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days * 24 * 60, n), unit="min")
+    values = rng.choice(np.arange(1500, 12000, 50), n) / 100
+    return pd.DataFrame({"numero": np.arange(1, n + 1) + 10_000_000,
+                         "momento": moments,
+                         "valor": values,
+                         "desconto": np.where(rng.random(n) < 0.2, 5.0, 0.0)})
+
+
+def _money(values):
+    return ["R$ " + f"{v:.2f}".replace(".", ",") for v in values]
+
+
+def delivery_export(orders, delivery):
+    """Monta o DataFrame no layout da exportação de cada delivery."""
+    dates = orders["momento"].dt.strftime("%d/%m/%Y %H:%M")
+    if delivery == "ifood":
+        return pd.DataFrame({"N° PEDIDO": orders["numero"], "DATA": orders["momento"].dt.strftime("%d/%m/%Y"),
+                             "CLIENTE": "Cliente", "VALOR DOS ITENS": orders["valor"],
+                             "TAXA DE ENTREGA": 5.99})
+    if delivery.startswith("mais_delivery"):
+        return pd.DataFrame({"Número": orders["numero"], "Data Pedido": dates, "Cliente": "Cliente",
+                             "Valor (R$)": _money(orders["valor"]),
+                             "Total com entrega (R$)": _money(orders["valor"] + 5)})
+    if delivery == "aiquefome":
+        return pd.DataFrame({"Nro. Pedido": orders["numero"], "Data": dates,
+                             "Total (R$)": _money(orders["valor"] - orders["desconto"]),
+                             "Desconto (R$)": _money(orders["desconto"]), "Status": "Entregue"})
+    if delivery == "goomer":
+        return pd.DataFrame({"ID do pedido": orders["numero"], "Data": dates, "Cupom": "",
+                             "Cupom (R$)": 0.0, "Total (R$)": _money(orders["valor"]),
+                             "Tipo": "Delivery", "Forma de pagamento": "Cartão"})
+    raise ValueError(delivery)
+
+
+def write_xlsx(df):
+    """Grava o DataFrame num .xlsx (em memória), linha a linha, e devolve os bytes."""
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "in_memory": True})
+    worksheet = workbook.add_worksheet("Pedidos")
+    worksheet.write_row(0, 0, list(df.columns))
+    for row, values in enumerate(zip(*[df[c].tolist() for c in df.columns]), start=1):
+        worksheet.write_row(row, 0, values)
+    workbook.close()
+    return output.getvalue()
+
+
+def break_styles(xlsx_bytes):
+    """
+    Reproduz as planilhas do Mais Delivery que o openpyxl não abre: um <fill/> vazio em
+    xl/styles.xml provoca "TypeError: expected <class 'openpyxl.styles.fills.Fill'>".
+    """
+    output = BytesIO()
+    with zipfile.ZipFile(BytesIO(xlsx_bytes)) as zin, zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zout:
+        for name in zin.namelist():
+            data = zin.read(name)
+            if name == "xl/styles.xml":
+                data = re.sub(rb"<fills[^>]*>.*?</fills>", b'<fills count="1"><fill/></fills>', data, flags=re.DOTALL)
+            zout.writestr(name, data)
+    return output.getvalue()
+
+
+def sqlite_factory(path):
+    def factory():
+        return sqlite3.connect(path, check_same_thread=False)
+    return factory
+
+
+def sqlite_pool(path, max_size=5):
+    """Pool de conexões para o banco de build_system_db, com o date() do SQLite para truncar no dia."""
+    return ConnectionPool(sqlite_factory(path), max_size=max_size, day_sql="date({})")
+
+
+def build_system_db(path, orders, id_delivery, id_forma, seed=0):
+    """
+    Banco SQLite com as tabelas usadas pela consulta do sistema (ContasAReceber e junções).
+    ~93% dos pedidos têm a venda correspondente, ~2% com diferença de centavos e ~2% a mais de
+    vendas sem pedido no delivery.
+    """
+    rng = np.random.default_rng(seed + 1)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        create table ContasAReceber(ID_Venda, ID_Empresa, ID_Caixa, id_origem_caixa, ID_Forma, ID_Cliente,
+                                    Documento_Cartao, Valor, Emissao, datacadastro);
+        create table FormasPagamento(ID_Forma, Descricao);
+        create table Fechamento_Caixas(ID_Empresa, ID_Caixa, ID_Origem_Caixa, ID_Usuario);
+        create table Usuarios(ID_Usuario, Nome);
+        create table Vendas_Sorveteria(ID_Empresa, ID_Venda, Data_Faturamento);
+        create table Empresas(ID_Empresa, TipoEmpresa, NomeFantasia);
+        create table Clientes(ID_Cliente, RazaoCliente);
+    """)
+    conn.execute("insert into FormasPagamento values (?, ?)", (id_forma, "DELIVERY"))
+    conn.execute("insert into Fechamento_Caixas values (?, 1, 1, 1)", (BENCH_EMPRESA,))
+    conn.execute("insert into Usuarios values (1, 'Caixa')")
+    conn.execute("insert into Empresas values (?, 'Sorveteria', 'Loja')", (BENCH_EMPRESA,))
+    conn.execute("insert into Clientes values (?, 'DELIVERY')", (id_delivery,))
+
+    draw = rng.random(len(orders))
+    kept = orders[draw >= 0.05].copy()
+    cents_off = draw[draw >= 0.05] < 0.07
+    kept.loc[cents_off, "valor"] = kept.loc[cents_off, "valor"] + 0.01
+    extra = generate_orders(max(1, len(orders) // 50), seed=seed + 2)
+    sales = pd.concat([kept, extra], ignore_index=True)
+    moments = sales["momento"].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+    rows = zip(range(1, len(sales) + 1), [BENCH_EMPRESA] * len(sales), [1] * len(sales), [1] * len(sales),
+               [id_forma] * len(sales), [id_delivery] * len(sales), sales["numero"].astype(str).tolist(),
+               sales["valor"].round(2).tolist(), moments, moments)
+    conn.executemany("insert into ContasAReceber values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def measure(fn, trace_memory=True):
+    """
+    Executa fn() medindo o tempo de parede e, se trace_memory, roda de novo sob o tracemalloc
+    para medir o pico de memória alocada (o rastreamento deixa a execução bem mais lenta, por
+    isso o tempo vem da primeira execução).
+    """
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        traced = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if hasattr(traced, "close"):
+            traced.close()
+        del traced
+    return result, elapsed, peak
+
+
+def bench_delivery(delivery, n, workdir, seed=0, trace_memory=True, match_ids=False):
+    """
+    Mede as etapas planilha, sistema, consolidação e exportação de um delivery com n pedidos.
+    Com match_ids, a consolidação pareia antes o nº do pedido com o NSU (o banco sintético grava
+    o número do pedido em Documento_Cartao).
+    """
+    spec = BENCH_DELIVERIES[delivery]
+    schema = DELIVERY_SCHEMAS[spec["id_delivery"]]
+    orders = generate_orders(n, seed=seed)
+    xlsx = write_xlsx(delivery_export(orders, delivery))
+    if spec["broken_styles"]:
+        xlsx = break_styles(xlsx)
+    db_path = os.path.join(workdir, f"sistema_{delivery}_{n}.db")
+    build_system_db(db_path, orders, spec["id_delivery"], spec["id_forma"], seed=seed)
+    pool = sqlite_pool(db_path, max_size=1)
+    start_date = orders["momento"].min().date()
+    end_date = orders["momento"].max().date()
+
+    rows = []
+
+    def record(stage, elapsed, peak, count, size=None):
+        rows.append({"delivery": delivery, "tamanho": n, "etapa": stage, "segundos": round(elapsed, 4),
+                     "linhas_por_s": round(count / elapsed) if elapsed else None,
+                     "pico_mb": round(peak / 2 ** 20, 1) if peak is not None else None,
+                     "bytes": size})
+
+    delivery_df, elapsed, peak = measure(lambda: process_delivery(BytesIO(xlsx), schema), trace_memory)
+    record("planilha", elapsed, peak, len(delivery_df), len(xlsx))
+
+    system_df, elapsed, peak = measure(lambda: run_system_query(start_date, end_date, BENCH_EMPRESA,
+                                                                [spec["id_delivery"]], [spec["id_forma"]],
+                                                                pool=pool, cache=False), trace_memory)
+    record("sistema", elapsed, peak, len(system_df))
+
+    order_delivery_cols = delivery_output_columns(schema)
+    result, elapsed, peak = measure(lambda: consolidate_data(
+        delivery_df, system_df, order_delivery_cols["Data Delivery"], order_delivery_cols["Valor Delivery"],
+        "Data_Faturamento", "Valor Bruto", order_delivery_cols, SYSTEM_OUTPUT_COLUMNS,
+        value_tolerance=0.05, date_tolerance_days=1, **id_match_columns(spec["id_delivery"], match_ids)),
+        trace_memory)
+    record("consolidação", elapsed, peak, len(result))
+
+    output, elapsed, peak = measure(lambda: export_consolidated(result, "xlsx"), trace_memory)
+    output.seek(0, os.SEEK_END)
+    record("exportação", elapsed, peak, len(result), output.tell())
+    output.close()
+    pool.close_all()
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark das etapas da consolidação com planilhas e banco (SQLite) sintéticos.")
+    parser.add_argument("--tamanhos", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="Quantidades de pedidos (ex.: 1000 10000 100000 1000000)")
+    parser.add_argument("--deliverys", nargs="+", choices=list(BENCH_DELIVERIES), default=list(BENCH_DELIVERIES))
+    parser.add_argument("--saida", help="Arquivo CSV para gravar os resultados")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sem-memoria", action="store_true",
+                        help="Não mede o pico de memória (evita a segunda execução de cada etapa)")
+    parser.add_argument("--por-pedido", action="store_true",
+                        help="Consolida pareando primeiro o nº do pedido com o NSU")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    warnings.simplefilter("ignore")
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in args.tamanhos:
+            for delivery in args.deliverys:
+                for row in bench_delivery(delivery, n, workdir, seed=args.seed,
+                                          trace_memory=not args.sem_memoria, match_ids=args.por_pedido):
+                    results.append(row)
+                    print(f"{row['delivery']:<34} {row['tamanho']:>9} {row['etapa']:<13} "
+                          f"{row['segundos']:>9.3f}s {row['linhas_por_s'] or 0:>11} linhas/s "
+                          f"{row['pico_mb'] if row['pico_mb'] is not None else '-':>8} MB", flush=True)
+    if args.saida:
+        with open(args.saida, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+from datetime import datetime
+
+from config import id_empresa_mapping, mapping_deliverys, allowed_deliveries, delivery_rules, delivery_tolerances
+from utils import (
+    configure, load_settings, consolidate_batch, build_batch_workbook, prepare_for_parquet,
+    ConsolidationError, RunMetrics, get_reconciliation_ledger
+)
+
+logger = logging.getLogger("app_deliverys")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Consolidação de deliverys x sistema sem a interface do Streamlit. "
+                    "As planilhas devem estar em --planilhas com o nome <id_empresa>_<id_delivery>.xlsx (ou .xls).")
+    parser.add_argument("--inicio", required=True, type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+                        help="Data inicial (AAAA-MM-DD)")
+    parser.add_argument("--fim", required=True, type=lambda s: datetime.strptime(s, "%Y-%m-%d").date(),
+                        help="Data final (AAAA-MM-DD)")
+    parser.add_argument("--planilhas", required=True, help="Diretório com as planilhas exportadas dos deliverys")
+    parser.add_argument("--saida", required=True, help="Diretório onde os resultados são gravados")
+    parser.add_argument("--lojas", type=int, nargs="*", help="IDs das empresas (padrão: todas)")
+    parser.add_argument("--deliverys", type=int, nargs="*", help="IDs dos deliverys (padrão: todos os permitidos)")
+    parser.add_argument("--formato", choices=["xlsx", "parquet"], default="xlsx",
+                        help="xlsx: um arquivo com uma aba por par; parquet: um arquivo por par")
+    parser.add_argument("--jobs", type=int, default=None, help="Processos em paralelo (padrão: um por par, até o nº de CPUs)")
+    parser.add_argument("--config", help="Arquivo TOML com as seções [mssql] e [conciliacao] (padrão: .streamlit/secrets.toml)")
+    parser.add_argument("--por-pedido", action="store_true",
+                        help="Pareia primeiro o nº do pedido do delivery com o NSU (Documento_Cartao) da venda")
+    parser.add_argument("--sem-historico", action="store_true",
+                        help="Ignora o histórico de pares já conciliados ([conciliacao] path) e refaz toda a correspondência")
+    parser.add_argument("--perfil", help="Diretório para gravar cProfile/tracemalloc de cada etapa (desligado por padrão)")
+    return parser.parse_args(argv)
+
+
+def find_uploads(directory, lojas=None, deliverys=None):
+    """Lê as planilhas de cada par loja x delivery permitido encontradas no diretório."""
+    uploads = {}
+    for id_empresa, allowed in allowed_deliveries.items():
+        if lojas and id_empresa not in lojas:
+            continue
+        for id_delivery in allowed:
+            if deliverys and id_delivery not in deliverys:
+                continue
+            files = sorted(glob.glob(os.path.join(directory, f"{id_empresa}_{id_delivery}.xls*")))
+            if not files:
+                logger.warning("Sem planilha para %s - %s", id_empresa_mapping[id_empresa], mapping_deliverys[id_delivery])
+                continue
+            with open(files[0], "rb") as f:
+                uploads[(id_empresa, id_delivery)] = f.read()
+    return uploads
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    configure(load_settings(args.config))
+    metrics = RunMetrics("lote", profile_dir=args.perfil)
+
+    uploads = find_uploads(args.planilhas, args.lojas, args.deliverys)
+    if not uploads:
+        logger.error("Nenhuma planilha encontrada em %s", args.planilhas)
+        return 1
+    try:
+        with metrics.stage("lote", bytes=sum(len(content) for content in uploads.values())) as info:
+            results = consolidate_batch(uploads, args.inicio, args.fim, delivery_rules, delivery_tolerances,
+                                        max_workers=args.jobs,
+                                        ledger=None if args.sem_historico else get_reconciliation_ledger(),
+                                        match_ids=args.por_pedido)
+            info["linhas"] = sum(len(df) for df in results.values())
+    except ConsolidationError as e:
+        logger.error("%s", e)
+        return 1
+
+    os.makedirs(args.saida, exist_ok=True)
+    period = f"{args.inicio:%Y%m%d}_{args.fim:%Y%m%d}"
+    for (id_empresa, id_delivery), df in results.items():
+        counts = df['Discrepância Inicial'].value_counts().to_dict()
+        logger.info("%s - %s: %s", id_empresa_mapping[id_empresa], mapping_deliverys[id_delivery], counts)
+    with metrics.stage("exportação", linhas=sum(len(df) for df in results.values())):
+        if args.formato == "parquet":
+            for (id_empresa, id_delivery), df in results.items():
+                path = os.path.join(args.saida, f"Consolidado_{id_empresa}_{id_delivery}_{period}.parquet")
+                prepare_for_parquet(df).to_parquet(path, index=False)
+                logger.info("Gravado %s", path)
+        else:
+            path = os.path.join(args.saida, f"Consolidado_{period}.xlsx")
+            build_batch_workbook(results, id_empresa_mapping, mapping_deliverys, target=path)
+            logger.info("Gravado %s", path)
+    for path in metrics.profile_files:
+        logger.info("Perfil gravado em %s", path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
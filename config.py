@@ -0,0 +1,51 @@
+# Cadastros compartilhados pela interface (home.py) e pelo executor em linha de comando (cli.py)
+
+# Mapeamento de empresas (lojas)
+id_empresa_mapping = {
+    58: 'Araguaína II',
+    53: 'Imperatriz II', 
+    50: 'Balsas I', 
+    56: 'Gurupi I',
+    46: 'Formosa I',
+    59: 'Guaraí'
+}
+
+# Mapeamento dos deliverys e regras de negócio
+mapping_deliverys = {
+    1032: "IFood.COM AG REST ONLINE S.A.",
+    1035: "MAIS DELIVERY ARAGUAINA LTDA",
+    1231: "AI QUE FOME",
+    709:  "GOOMER",
+    202:  "IFood.COM",
+    1205: "EDVANIA SOBRINHO DA SILVA"
+}
+
+# Relação de deliverys permitidos por loja
+allowed_deliveries = {
+    58: [1032, 1035, 1231, 709],
+    53: [202],
+    50: [1032],
+    56: [1032, 1231],
+    46: [1032],
+    59: [1205]
+}
+
+# Regras para filtrar os dados do sistema (para cada delivery)
+delivery_rules = {
+    1032: {"client_ids": [1032], "id_forma": [17]}, 
+    1035: {"client_ids": [1035], "id_forma": [18]},
+    1231: {"client_ids": [1231], "id_forma": [37]},
+    709:  {"client_ids": [709], "id_forma": [1,31,5,6]},
+    202:  {"client_ids": [202], "id_forma": [17]},
+    1205: {"client_ids": [1205], "id_forma": [1,31,5,6]}
+}
+
+# Tolerâncias padrão da segunda passada de correspondência (valor em R$ e dias)
+delivery_tolerances = {
+    1032: {"valor": 0.05, "dias": 1},
+    1035: {"valor": 0.05, "dias": 1},
+    1231: {"valor": 0.05, "dias": 1},
+    709:  {"valor": 0.05, "dias": 1},
+    202:  {"valor": 0.05, "dias": 1},
+    1205: {"valor": 0.05, "dias": 1}
+}
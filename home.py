@@ -1,53 +1,34 @@
 import streamlit as st
-import pandas as pd
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from io import BytesIO
+from functools import partial
+from config import (
+    id_empresa_mapping, mapping_deliverys, allowed_deliveries, delivery_rules, delivery_tolerances
+)
 from utils import (
-    get_db_connection, run_system_query, process_ifood, process_mais_delivery,
-    process_aiquefome, process_goomer, process_edvania, consolidate_data
+    run_system_query, consolidate_data, parse_delivery_cached, process_delivery,
+    delivery_output_columns, DELIVERY_SCHEMAS, SYSTEM_OUTPUT_COLUMNS, consolidate_batch,
+    build_batch_workbook, configure, load_settings, ConsolidationError, export_consolidated, EXPORT_FORMATS,
+    RunMetrics, get_settings, get_reconciliation_ledger, consolidate_with_ledger,
+    money_in_reais, delivery_money_columns, id_match_columns, run_system_daily_totals, consolidate_two_phase
 )
 
 st.title("Consolidação de Deliverys e Sistema")
 
-# Mapeamento de empresas (lojas)
-id_empresa_mapping = {
-    58: 'Araguaína II',
-    53: 'Imperatriz II', 
-    50: 'Balsas I', 
-    56: 'Gurupi I',
-    46: 'Formosa I',
-    59: 'Guaraí'
-}
-
-# Mapeamento dos deliverys e regras de negócio
-mapping_deliverys = {
-    1032: "IFood.COM AG REST ONLINE S.A.",
-    1035: "MAIS DELIVERY ARAGUAINA LTDA",
-    1231: "AI QUE FOME",
-    709:  "GOOMER",
-    202:  "IFood.COM",
-    1205: "EDVANIA SOBRINHO DA SILVA"
-}
-
-# Relação de deliverys permitidos por loja
-allowed_deliveries = {
-    58: [1032, 1035, 1231, 709],
-    53: [202],
-    50: [1032],
-    56: [1032, 1231],
-    46: [1032],
-    59: [1205]
-}
+def streamlit_secrets():
+    # Sem secrets.toml o st.secrets levanta FileNotFoundError; valem o arquivo de load_settings e as MSSQL_*
+    try:
+        return dict(st.secrets.items())
+    except FileNotFoundError:
+        return {}
 
-# Regras para filtrar os dados do sistema (para cada delivery)
-delivery_rules = {
-    1032: {"client_ids": [1032], "id_forma": [17]}, 
-    1035: {"client_ids": [1035], "id_forma": [18]},
-    1231: {"client_ids": [1231], "id_forma": [37]},
-    709:  {"client_ids": [709], "id_forma": [1,31,5,6]},
-    202:  {"client_ids": [202], "id_forma": [17]},
-    1205: {"client_ids": [1205], "id_forma": [1,31,5,6]}
-}
+# As credenciais e ajustes vêm do secrets do Streamlit, do arquivo de configuração e das variáveis MSSQL_*
+configure(load_settings(secrets=streamlit_secrets()))
+# Métricas de cada etapa saem no log como linhas JSON
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
 
 # Interface de filtros na sidebar
 st.sidebar.header("Filtros de Consolidação")
@@ -61,6 +42,31 @@ selected_delivery = st.sidebar.selectbox("Selecione o Delivery",
                                            format_func=lambda x: delivery_options[x])
 start_date = st.sidebar.date_input("Data Inicial", value=datetime.today())
 end_date = st.sidebar.date_input("Data Final", value=datetime.today())
+tolerance = delivery_tolerances.get(selected_delivery, {"valor": 0.0, "dias": 0})
+value_tolerance = st.sidebar.number_input("Tolerância de valor (R$)", min_value=0.0,
+                                          value=tolerance["valor"], step=0.01, format="%.2f")
+date_tolerance_days = st.sidebar.number_input("Tolerância de dias", min_value=0,
+                                              value=tolerance["dias"], step=1)
+match_ids = st.sidebar.checkbox("Parear primeiro pelo nº do pedido x NSU",
+                                help="Pedidos cujo número coincide com o NSU (Documento_Cartao) da venda são "
+                                     "pareados antes da correspondência por data e valor.")
+two_phase = st.sidebar.checkbox("Conferir primeiro os totais por dia",
+                                help="O banco devolve só os totais de cada dia; as vendas são buscadas apenas "
+                                     "nos dias em que os totais não batem com a planilha (o histórico de pares "
+                                     "não é usado nesse modo).")
+refresh_cache = st.sidebar.checkbox("Consultar o sistema de novo (ignorar o cache)",
+                                    help="Use depois de corrigir vendas no sistema: todos os dias do período "
+                                         "são lidos do banco e o cache é atualizado.")
+export_format = st.sidebar.selectbox("Formato do download", options=list(EXPORT_FORMATS.keys()))
+ledger = get_reconciliation_ledger()
+if ledger is not None:
+    use_ledger = st.sidebar.checkbox("Reaproveitar pares já conciliados", value=True)
+    if st.sidebar.button("Esquecer pares do período"):
+        removed = ledger.forget(selected_company_id, selected_delivery, start_date, end_date)
+        st.sidebar.write(f"{removed} pares removidos do histórico.")
+else:
+    use_ledger = False
+profile_enabled = st.sidebar.checkbox("Gerar perfil de desempenho (cProfile/tracemalloc)")
 
 st.write(f"**Empresa selecionada:** {id_empresa_mapping[selected_company_id]}")
 st.write(f"**Delivery selecionado:** {mapping_deliverys[selected_delivery]}")
@@ -72,110 +78,181 @@ if st.button("Consolidar"):
     if not uploaded_file:
         st.error("Carregue a planilha do delivery.")
     else:
-        st.info("Executando consulta no sistema...")
-        # Obter os dados do sistema conforme os filtros e regras do delivery
-        drules = delivery_rules[selected_delivery]
-        system_df = run_system_query(start_date, end_date, selected_company_id, drules["client_ids"], drules["id_forma"])
-        st.write("**Dados do sistema obtidos:**")
-        st.dataframe(system_df.head())
-        
-        # Processar a planilha do delivery conforme o tipo selecionado
-        if selected_delivery in [1032, 202]:
-            delivery_df = process_ifood(uploaded_file)
-        elif selected_delivery == 1035:
-            delivery_df = process_mais_delivery(uploaded_file)
-        elif selected_delivery == 1231:
-            delivery_df = process_aiquefome(uploaded_file)
-        elif selected_delivery == 709:
-            delivery_df = process_goomer(uploaded_file)
-        elif selected_delivery == 1205:
-            delivery_df = process_edvania(uploaded_file)
-        else:
+        profile_dir = get_settings().get("profiling", {}).get("dir", "perfis") if profile_enabled else None
+        metrics = RunMetrics(f"{selected_company_id}_{selected_delivery}", profile_dir=profile_dir)
+        schema = DELIVERY_SCHEMAS.get(selected_delivery)
+        if schema is None:
             st.error("Delivery não suportado.")
             st.stop()
+        drules = delivery_rules[selected_delivery]
+        cancel_event = threading.Event()
         
-        st.write("**Dados do delivery:**")
-        st.dataframe(delivery_df.head())
+        # Obter os dados do sistema conforme os filtros e regras do delivery
+        # (em duas fases, só os totais por dia; as vendas vêm depois, nos dias que não batem)
+        def fetch_system():
+            with metrics.stage("sistema") as info:
+                if two_phase:
+                    df = run_system_daily_totals(start_date, end_date, selected_company_id,
+                                                 drules["client_ids"], drules["id_forma"])
+                else:
+                    df = run_system_query(start_date, end_date, selected_company_id, drules["client_ids"],
+                                          drules["id_forma"], cancel_event=cancel_event, refresh=refresh_cache)
+                info["linhas"] = len(df)
+            return df
         
-        # Definir os mapeamentos para as colunas de consolidação (delivery x sistema)
-        if selected_delivery in [1032, 202]:
-            order_delivery_cols = {
-                'Pedido Delivery': 'N° PEDIDO IFOOD',
-                'Data Delivery': 'DATA IFOOD',
-                'Valor Delivery': 'VALOR IFOOD'
-            }
-        elif selected_delivery == 1035:
-            order_delivery_cols = {
-                'Pedido Delivery': 'N° PEDIDO MAIS DELIVERY',
-                'Data Delivery': 'DATA MAIS DELIVERY',
-                'Valor Delivery': 'VALOR MAIS DELIVERY'
-            }
-        elif selected_delivery == 1231:
-            order_delivery_cols = {
-                'Pedido Delivery': 'N° PEDIDO AI QUE FOME',
-                'Data Delivery': 'DATA AI QUE FOME',
-                'Valor Delivery': 'Valor AI QUE FOME'
-            }
-        elif selected_delivery == 709:
-            order_delivery_cols = {
-                'Pedido Delivery': 'N° PEDIDO GOOMER',
-                'Data Delivery': 'DATA GOOMER',
-                'Valor Delivery': 'VALOR GOOMER'
-            }
-        elif selected_delivery == 1205:
-            order_delivery_cols = {
-                'Pedido Delivery': 'N° PEDIDO MAIS DELIVERY',
-                'Data Delivery': 'DATA MAIS DELIVERY',
-                'Valor Delivery': 'VALOR MAIS DELIVERY'
-            }
+        # Processar a planilha do delivery conforme o esquema do delivery selecionado
+        # (o resultado fica em cache pelo conteúdo do arquivo, evitando reprocessar nas reexecuções)
+        def parse_delivery():
+            with metrics.stage("planilha", bytes=uploaded_file.size) as info:
+                df = parse_delivery_cached(uploaded_file, selected_delivery, partial(process_delivery, schema=schema))
+                info["linhas"] = len(df)
+            return df
+        
+        # A consulta (rede) e a planilha (CPU/disco) rodam ao mesmo tempo; as mensagens de
+        # progresso são atualizadas aqui, pois o Streamlit só pode ser usado na thread do script
+        labels = {"sistema": "Consulta ao sistema", "planilha": "Planilha do delivery"}
+        progress = {name: st.empty() for name in labels}
+        for name, label in labels.items():
+            progress[name].info(f"{label}: em andamento...")
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="consolidar")
+        futures = {executor.submit(fetch_system): "sistema", executor.submit(parse_delivery): "planilha"}
+        results = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                error = future.exception()
+                if error is not None:
+                    # Interrompe a outra etapa (a consulta para no próximo lote) e não espera por ela
+                    cancel_event.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    for other in pending:
+                        progress[futures[other]].warning(f"{labels[futures[other]]}: cancelada.")
+                    progress[name].error(f"{labels[name]}: falhou.")
+                    if not isinstance(error, ConsolidationError):
+                        raise error
+                    st.error(str(error))
+                    st.stop()
+                results[name] = future.result()
+                progress[name].success(f"{labels[name]}: {len(results[name])} linhas "
+                                       f"em {time.perf_counter() - started:.1f}s.")
+        executor.shutdown()
+        system_df, delivery_df = results["sistema"], results["planilha"]
+        
+        # Os valores ficam em centavos; só a exibição converte para R$
+        if two_phase:
+            st.write("**Totais do sistema por dia:**")
+            st.dataframe(money_in_reais(system_df.head(), ['centavos']))
         else:
-            st.error("Mapping de colunas não definido para este delivery.")
-            st.stop()
+            st.write("**Dados do sistema obtidos:**")
+            st.dataframe(money_in_reais(system_df.head(), ['Valor Bruto']))
+        st.write("**Dados do delivery:**")
+        st.dataframe(money_in_reais(delivery_df.head(), delivery_money_columns(schema)))
         
-        order_system_cols = {
-            'ID Venda Sistema': 'ID_Venda',
-            'Data Sistema': 'Data_Faturamento',
-            'Valor Sistema': 'Valor Bruto'
-        }
+        # Definir os mapeamentos para as colunas de consolidação (delivery x sistema)
+        order_delivery_cols = delivery_output_columns(schema)
+        order_system_cols = SYSTEM_OUTPUT_COLUMNS
         
         # Definir as colunas de data e valor para a consolidação
-        if selected_delivery in [1032, 202]:
-            date_col_delivery = 'DATA IFOOD'
-            value_col_delivery = 'VALOR IFOOD'
-        elif selected_delivery == 1035:
-            date_col_delivery = 'DATA MAIS DELIVERY'
-            value_col_delivery = 'VALOR MAIS DELIVERY'
-        elif selected_delivery == 1231:
-            date_col_delivery = 'DATA AI QUE FOME'
-            value_col_delivery = 'Valor AI QUE FOME'
-        elif selected_delivery == 709:
-            date_col_delivery = 'DATA GOOMER'
-            value_col_delivery = 'VALOR GOOMER'
-        elif selected_delivery == 1205:
-            date_col_delivery = 'DATA MAIS DELIVERY'
-            value_col_delivery = 'VALOR MAIS DELIVERY'
-        else:
-            st.error("Não foi possível definir as colunas para consolidação.")
-            st.stop()
+        date_col_delivery = order_delivery_cols['Data Delivery']
+        value_col_delivery = order_delivery_cols['Valor Delivery']
         date_col_system = 'Data_Faturamento'
         value_col_system = 'Valor Bruto'
         
-        consolidated_df = consolidate_data(delivery_df.copy(), system_df.copy(),
-                                             date_col_delivery, value_col_delivery,
-                                             date_col_system, value_col_system,
-                                             order_delivery_cols, order_system_cols)
+        with metrics.stage("consolidação") as info:
+            if two_phase:
+                # Dias cujos totais batem saem direto; os demais são detalhados e pareados
+                consolidated_df = consolidate_two_phase(delivery_df, start_date, end_date,
+                                                        selected_company_id, selected_delivery,
+                                                        drules["client_ids"], drules["id_forma"],
+                                                        value_tolerance=value_tolerance,
+                                                        date_tolerance_days=int(date_tolerance_days),
+                                                        match_ids=match_ids, system_totals=system_df,
+                                                        refresh=refresh_cache)
+            elif use_ledger:
+                # Só os pedidos e vendas fora do histórico passam pela correspondência
+                consolidated_df = consolidate_with_ledger(delivery_df, system_df,
+                                                          selected_company_id, selected_delivery, ledger,
+                                                          value_tolerance=value_tolerance,
+                                                          date_tolerance_days=int(date_tolerance_days),
+                                                          match_ids=match_ids)
+            else:
+                consolidated_df = consolidate_data(delivery_df.copy(), system_df.copy(),
+                                                     date_col_delivery, value_col_delivery,
+                                                     date_col_system, value_col_system,
+                                                     order_delivery_cols, order_system_cols,
+                                                     value_tolerance=value_tolerance,
+                                                     date_tolerance_days=int(date_tolerance_days),
+                                                     **id_match_columns(selected_delivery, match_ids))
+            info["linhas"] = len(consolidated_df)
         
         st.write("**Resultado da Consolidação:**")
         st.dataframe(consolidated_df.head())
         
-        # Gerar arquivo Excel para download
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            consolidated_df.to_excel(writer, index=False, sheet_name='Consolidado')
-        processed_data = output.getvalue()
+        # Gerar o arquivo para download no formato escolhido (xlsx inclui a aba de resumo diário)
+        mime, extension = EXPORT_FORMATS[export_format]
+        with metrics.stage("exportação", linhas=len(consolidated_df)) as info:
+            # O download_button não aceita o arquivo temporário; o conteúdo vai como bytes
+            with export_consolidated(consolidated_df, export_format) as export_file:
+                export_data = export_file.read()
+            info["bytes"] = len(export_data)
         st.download_button(
             label='Baixar planilha consolidada',
-            data=processed_data,
-            file_name=f"Consolidado_{mapping_deliverys[selected_delivery]}.xlsx",
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            data=export_data,
+            file_name=f"Consolidado_{mapping_deliverys[selected_delivery]}{extension}",
+            mime=mime
         )
+        
+        with st.expander("Desempenho por etapa"):
+            st.dataframe(metrics.to_frame())
+            if metrics.profile_files:
+                st.write("Perfis gravados em:")
+                st.code("\n".join(metrics.profile_files))
+
+# Consolidação em lote: todos os pares loja x delivery de uma vez, num único arquivo
+with st.expander("Consolidação em lote (várias lojas e deliverys)"):
+    st.write("Carregue as planilhas dos pares que deseja consolidar no período selecionado. "
+             "As vendas são lidas direto do banco, numa única consulta, sem o cache por dia.")
+    sidebar_tolerances = st.checkbox(
+        f"Usar em todos os pares as tolerâncias da sidebar (R$ {value_tolerance:.2f} e {int(date_tolerance_days)} dias)",
+        value=True, help="Desmarcado, cada delivery usa as tolerâncias padrão definidas em config.py.")
+    batch_uploads = {}
+    for id_empresa, deliveries in allowed_deliveries.items():
+        for id_delivery in deliveries:
+            batch_file = st.file_uploader(
+                f"{id_empresa_mapping[id_empresa]} - {mapping_deliverys[id_delivery]}",
+                type=["xlsx", "xls"], key=f"lote_{id_empresa}_{id_delivery}")
+            if batch_file:
+                batch_uploads[(id_empresa, id_delivery)] = batch_file.getvalue()
+    if st.button("Consolidar lote"):
+        if not batch_uploads:
+            st.error("Carregue ao menos uma planilha.")
+        else:
+            if sidebar_tolerances:
+                batch_tolerances = {id_delivery: {"valor": value_tolerance, "dias": int(date_tolerance_days)}
+                                    for _, id_delivery in batch_uploads}
+            else:
+                batch_tolerances = delivery_tolerances
+            with st.spinner(f"Consolidando {len(batch_uploads)} pares..."):
+                try:
+                    batch_results = consolidate_batch(batch_uploads, start_date, end_date,
+                                                      delivery_rules, batch_tolerances,
+                                                      ledger=ledger if use_ledger else None,
+                                                      match_ids=match_ids)
+                except ConsolidationError as e:
+                    st.error(str(e))
+                    st.stop()
+            for (id_empresa, id_delivery), result_df in batch_results.items():
+                counts = result_df['Discrepância Inicial'].value_counts()
+                st.write(f"**{id_empresa_mapping[id_empresa]} - {mapping_deliverys[id_delivery]}:** "
+                         + ", ".join(f"{status}: {count}" for status, count in counts.items()))
+            with build_batch_workbook(batch_results, id_empresa_mapping, mapping_deliverys) as batch_file:
+                batch_data = batch_file.read()
+            st.download_button(
+                label='Baixar planilha consolidada do lote',
+                data=batch_data,
+                file_name="Consolidado_lote.xlsx",
+                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import sys
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+import utils  # noqa: E402
+
+IFOOD = 1032
+IFOOD_FORMA = 17
+EMPRESA = benchmark.BENCH_EMPRESA
+
+
+def build_system_db(path, orders, exact=False):
+    """
+    Banco SQLite no formato de ContasAReceber (o mesmo do benchmark), com o pool para consultá-lo.
+    Com exact, cada pedido tem exatamente a sua venda (mesmo número no NSU, data e valor); sem,
+    há vendas faltando, com centavos de diferença e sem pedido.
+    """
+    benchmark.build_system_db(path, orders, IFOOD, IFOOD_FORMA, seed=5)
+    if exact:
+        conn = sqlite3.connect(path)
+        conn.execute("delete from ContasAReceber")
+        moments = orders["momento"].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+        conn.executemany("insert into ContasAReceber values (?, ?, 1, 1, ?, ?, ?, ?, ?, ?)",
+                         [(i + 1, EMPRESA, IFOOD_FORMA, IFOOD, str(numero), round(valor, 2), moment, moment)
+                          for i, (numero, valor, moment)
+                          in enumerate(zip(orders["numero"], orders["valor"], moments))])
+        conn.commit()
+        conn.close()
+    return benchmark.sqlite_pool(path)
+
+
+def period(orders):
+    return orders["momento"].min().date(), orders["momento"].max().date()
+
+
+@pytest.fixture
+def orders():
+    return benchmark.generate_orders(2000, seed=5)
+
+
+@pytest.fixture
+def delivery_df(orders):
+    """Planilha do iFood gerada a partir dos pedidos e lida por process_delivery."""
+    data = benchmark.write_xlsx(benchmark.delivery_export(orders, "ifood"))
+    return utils.process_delivery(BytesIO(data), utils.DELIVERY_SCHEMAS[IFOOD])
+
+
+@pytest.fixture
+def system_pool(tmp_path, orders):
+    return build_system_db(str(tmp_path / "sistema.db"), orders)
+
+
+@pytest.fixture
+def exact_pool(tmp_path, orders):
+    return build_system_db(str(tmp_path / "sistema_exato.db"), orders, exact=True)
+
+
+def consolidate(delivery_df, system_df, value_tolerance=0.0, date_tolerance_days=0, **kwargs):
+    """consolidate_data com as colunas do iFood e do sistema."""
+    cols = utils.delivery_output_columns(utils.DELIVERY_SCHEMAS[IFOOD])
+    return utils.consolidate_data(delivery_df, system_df, cols["Data Delivery"], cols["Valor Delivery"],
+                                  "Data_Faturamento", "Valor Bruto", cols, utils.SYSTEM_OUTPUT_COLUMNS,
+                                  value_tolerance=value_tolerance, date_tolerance_days=date_tolerance_days,
+                                  **kwargs)
+
+
+def statuses_by_order(result):
+    """'Discrepância Inicial' de cada pedido do delivery, indexada pelo número do pedido."""
+    rows = result[result["Pedido Delivery"].notna()]
+    return rows.set_index("Pedido Delivery")["Discrepância Inicial"].astype(str).sort_index()
+
+
+def system_frame(ids, dates, cents, nsu=None):
+    return pd.DataFrame({"ID_Venda": ids, "NSU": nsu if nsu is not None else [None] * len(ids),
+                         "Data_Faturamento": pd.to_datetime(dates), "Valor Bruto": pd.array(cents, dtype="int64")})
+
+
+def delivery_frame(orders_ids, dates, cents):
+    return pd.DataFrame({"N° PEDIDO IFOOD": orders_ids, "DATA IFOOD": pd.to_datetime(dates),
+                         "VALOR IFOOD": pd.array(cents, dtype="int64")})
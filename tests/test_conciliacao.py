@@ -0,0 +1,110 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import utils
+from conftest import (EMPRESA, IFOOD, IFOOD_FORMA, build_system_db, consolidate, delivery_frame, period,
+                      statuses_by_order, system_frame)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return utils.ReconciliationLedger(str(tmp_path / "conciliacao.sqlite"))
+
+
+def test_ledger_records_only_unambiguous_pairs(ledger):
+    # 111 e 222 têm a mesma data e o mesmo valor: o par por data e valor é arbitrário
+    delivery = delivery_frame([111, 222, 333], ["2025-01-01"] * 3, [1000, 1000, 2500])
+    system = system_frame([1, 2, 3], ["2025-01-01"] * 3, [1000, 1000, 2500], nsu=["222", "111", "333"])
+    utils.consolidate_with_ledger(delivery, system, EMPRESA, IFOOD, ledger)
+    assert ledger.confirmed(EMPRESA, IFOOD).values.tolist() == [["333", "3"]]
+
+    # Com o pedido x NSU os pares repetidos saem corretos e passam a ser gravados
+    result = utils.consolidate_with_ledger(delivery, system, EMPRESA, IFOOD, ledger, match_ids=True)
+    pairs = result.set_index("Pedido Delivery")
+    assert pairs.loc[111, "ID Venda Sistema"] == 2
+    assert pairs.loc[222, "ID Venda Sistema"] == 1
+    assert pairs.loc[333, "Regra"] == "Histórico"
+    assert sorted(ledger.confirmed(EMPRESA, IFOOD).values.tolist()) == [["111", "2"], ["222", "1"], ["333", "3"]]
+
+
+def test_ledger_reuses_confirmed_pairs(ledger, delivery_df, system_pool, orders):
+    start, end = period(orders)
+    system_df = utils.run_system_query(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=system_pool, cache=False)
+    first = utils.consolidate_with_ledger(delivery_df, system_df, EMPRESA, IFOOD, ledger, 0.05, 1)
+    second = utils.consolidate_with_ledger(delivery_df, system_df, EMPRESA, IFOOD, ledger, 0.05, 1)
+    assert (second["Regra"] == "Histórico").sum() == len(ledger.confirmed(EMPRESA, IFOOD)) > 0
+    assert statuses_by_order(second).equals(statuses_by_order(first))
+    assert ledger.forget(EMPRESA, IFOOD, start, end) == len(second[second["Regra"] == "Histórico"])
+
+
+def test_ledger_rechecks_pairs_whose_sale_changed(ledger):
+    delivery = delivery_frame([111], ["2025-01-01"], [2500])
+    utils.consolidate_with_ledger(delivery, system_frame([3], ["2025-01-01"], [2500]), EMPRESA, IFOOD, ledger)
+    assert ledger.confirmed(EMPRESA, IFOOD).values.tolist() == [["111", "3"]]
+
+    # A venda 3 mudou de valor e de data: o par não vale mais e sai do histórico
+    changed = system_frame([3], ["2025-01-09"], [3000])
+    result = utils.consolidate_with_ledger(delivery, changed, EMPRESA, IFOOD, ledger)
+    assert (result["Discrepância Inicial"] == "Diferença").all()
+    assert "Histórico" not in set(result["Regra"])
+    assert ledger.confirmed(EMPRESA, IFOOD).empty
+
+    # Dentro das tolerâncias o par é reaproveitado, marcado como tolerância
+    utils.consolidate_with_ledger(delivery, system_frame([3], ["2025-01-01"], [2500]), EMPRESA, IFOOD, ledger)
+    nudged = system_frame([3], ["2025-01-02"], [2503])
+    result = utils.consolidate_with_ledger(delivery, nudged, EMPRESA, IFOOD, ledger, 0.05, 1)
+    assert result[["Discrepância Inicial", "Regra"]].values.tolist() == [["Correspondente (tolerância)", "Histórico"]]
+
+
+def test_ledger_ignores_sales_split_across_rows(ledger):
+    # A venda 7 aparece em duas linhas: o número não identifica qual delas é a do pedido
+    delivery = delivery_frame([1, 2], ["2025-01-01"] * 2, [1000, 2000])
+    system = system_frame([7, 7], ["2025-01-01"] * 2, [2000, 1000])
+    for _ in range(2):
+        result = utils.consolidate_with_ledger(delivery, system, EMPRESA, IFOOD, ledger)
+        assert ledger.confirmed(EMPRESA, IFOOD).empty
+        pairs = result.set_index("Pedido Delivery")
+        assert pairs.loc[1, "Valor Sistema"] == pairs.loc[1, "Valor Delivery"] == 10.0
+        assert pairs.loc[2, "Valor Sistema"] == pairs.loc[2, "Valor Delivery"] == 20.0
+        assert (result["Discrepância Inicial"] == "Correspondente").all()
+
+
+def two_phase(delivery_df, pool, orders, value_tolerance=0.0, date_tolerance_days=0):
+    start, end = period(orders)
+    return utils.consolidate_two_phase(delivery_df, start, end, EMPRESA, IFOOD, [IFOOD], [IFOOD_FORMA],
+                                       value_tolerance, date_tolerance_days, pool=pool, cache=False)
+
+
+def single_phase(delivery_df, pool, orders, value_tolerance=0.0, date_tolerance_days=0):
+    start, end = period(orders)
+    system_df = utils.run_system_query(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=pool, cache=False)
+    return consolidate(delivery_df, system_df, value_tolerance, date_tolerance_days)
+
+
+def test_two_phase_clean_days_skip_the_detail(delivery_df, exact_pool, orders):
+    result = two_phase(delivery_df, exact_pool, orders)
+    assert (result["Regra"] == "Totais do dia").all()
+    assert (result["Discrepância Inicial"] == "Correspondente").all()
+    assert result[["ID Venda Sistema", "Data Sistema", "Valor Sistema"]].isna().all().all()
+    summary = utils.build_daily_summary(result)
+    assert (summary["Diferença (R$)"] == 0).all()
+
+
+@pytest.mark.parametrize("value_tolerance, date_tolerance_days", [(0.0, 0), (0.05, 1)])
+def test_two_phase_agrees_with_single_phase(tmp_path, delivery_df, orders, value_tolerance, date_tolerance_days):
+    # Algumas vendas faturadas no dia seguinte ao da emissão
+    path = str(tmp_path / "faturamento.db")
+    pool = build_system_db(path, orders, exact=True)
+    conn = sqlite3.connect(path)
+    conn.execute("update ContasAReceber set datacadastro = datetime(datacadastro, '+1 day') where ID_Venda % 97 = 0")
+    conn.commit()
+    conn.close()
+    for pool in (pool, build_system_db(str(tmp_path / "ruido.db"), orders)):
+        expected = single_phase(delivery_df, pool, orders, value_tolerance, date_tolerance_days)
+        result = two_phase(delivery_df, pool, orders, value_tolerance, date_tolerance_days)
+        assert statuses_by_order(result).equals(statuses_by_order(expected))
+        assert result["Pedido Delivery"].isna().sum() == expected["Pedido Delivery"].isna().sum()
+        totals = ["Total delivery (R$)", "Total sistema (R$)"]
+        assert np.allclose(utils.build_daily_summary(result)[totals], utils.build_daily_summary(expected)[totals])
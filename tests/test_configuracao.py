@@ -0,0 +1,38 @@
+import os
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import utils
+
+HOME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "home.py")
+
+
+@pytest.fixture
+def clean_settings(monkeypatch, tmp_path):
+    """Sem secrets.toml nem configuração global: o diretório atual é um diretório vazio."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("APP_DELIVERYS_CONFIG", raising=False)
+    for key in ("SERVER", "DATABASE", "USERNAME", "PASSWORD"):
+        monkeypatch.delenv(f"MSSQL_{key}", raising=False)
+    monkeypatch.setattr(utils, "_settings", None)
+    yield tmp_path
+    utils.configure(None)
+
+
+def test_environment_overrides_secrets_and_file(clean_settings, monkeypatch):
+    path = clean_settings / "config.toml"
+    path.write_text('[mssql]\nserver = "arquivo"\ndatabase = "base"\n[cache]\nttl = 60\n')
+    monkeypatch.setenv("MSSQL_SERVER", "ambiente")
+    settings = utils.load_settings(str(path), secrets={"mssql": {"database": "secrets", "username": "u"}})
+    assert settings["mssql"] == {"server": "ambiente", "database": "secrets", "username": "u"}
+    assert settings["cache"] == {"ttl": 60}
+
+
+def test_home_loads_without_secrets_file(clean_settings, monkeypatch):
+    monkeypatch.setenv("MSSQL_SERVER", "ambiente")
+    app = AppTest.from_file(HOME, default_timeout=60)
+    app.run()
+    assert not app.exception
+    assert app.title[0].value == "Consolidação de Deliverys e Sistema"
+    assert utils.get_settings()["mssql"]["server"] == "ambiente"
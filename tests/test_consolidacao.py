@@ -0,0 +1,159 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+from conftest import (EMPRESA, IFOOD, IFOOD_FORMA, consolidate, delivery_frame, period, statuses_by_order,
+                      system_frame)
+
+
+def reference_consolidate(delivery, system):
+    """
+    O laço original de consolidate_data: cada pedido, na ordem de data e valor, fica com a
+    primeira venda ainda livre com a mesma data e o mesmo valor. Retorna (lado, data, valor,
+    status) de cada linha, pedidos primeiro e depois as vendas sem par.
+    """
+    delivery = delivery.sort_values(["data", "valor"])
+    system = system.sort_values(["data", "valor"]).reset_index(drop=True)
+    matched = np.zeros(len(system), dtype=bool)
+    rows = []
+    for order in delivery.itertuples():
+        condition = ((system["data"] == order.data) & (system["valor"] == order.valor)).to_numpy() & ~matched
+        hits = np.flatnonzero(condition)
+        if len(hits):
+            matched[hits[0]] = True
+            rows.append(("delivery", order.data, order.valor, "Correspondente"))
+        else:
+            rows.append(("delivery", order.data, order.valor, "Diferença"))
+    for sale in system[~matched].itertuples():
+        rows.append(("sistema", sale.data, sale.valor, "Diferença"))
+    return pd.DataFrame(rows, columns=["lado", "data", "valor", "status"])
+
+
+def result_keys(result):
+    """As mesmas tuplas (lado, data, valor, status) a partir do resultado de consolidate_data."""
+    is_delivery = result["Pedido Delivery"].notna()
+    return pd.DataFrame({
+        "lado": np.where(is_delivery, "delivery", "sistema"),
+        "data": result["Data Delivery"].where(is_delivery, result["Data Sistema"]),
+        "valor": np.round(result["Valor Delivery"].where(is_delivery, result["Valor Sistema"]) * 100).astype(np.int64),
+        "status": result["Discrepância Inicial"].astype(str),
+    })
+
+
+def counts(keys):
+    return keys.fillna({"data": pd.Timestamp(0)}).value_counts().sort_index()
+
+
+def test_same_result_as_the_original_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n_delivery, n_system = rng.integers(0, 60, 2)
+        day = lambda n: pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 4, n), unit="D")
+        delivery = pd.DataFrame({"pedido": np.arange(n_delivery) + 1, "data": day(n_delivery),
+                                 "valor": rng.choice([1000, 1050, 2000, 2590], n_delivery)})
+        delivery.loc[rng.random(n_delivery) < 0.05, "data"] = pd.NaT
+        system = pd.DataFrame({"id": np.arange(n_system) + 1, "data": day(n_system),
+                               "valor": rng.choice([1000, 1050, 2000, 2590], n_system)})
+        expected = reference_consolidate(delivery, system)
+        result = consolidate(delivery_frame(delivery["pedido"], delivery["data"], delivery["valor"]),
+                             system_frame(system["id"], system["data"], system["valor"]))
+        pd.testing.assert_series_equal(counts(result_keys(result)), counts(expected))
+
+
+def test_benchmark_spreadsheet_matches_the_original_loop(delivery_df, system_pool, orders):
+    start, end = period(orders)
+    system_df = utils.run_system_query(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=system_pool, cache=False)
+    result = consolidate(delivery_df, system_df)
+    expected = reference_consolidate(
+        pd.DataFrame({"data": delivery_df["DATA IFOOD"], "valor": delivery_df["VALOR IFOOD"]}),
+        pd.DataFrame({"data": system_df["Data_Faturamento"], "valor": system_df["Valor Bruto"]}))
+    pd.testing.assert_series_equal(counts(result_keys(result)), counts(expected))
+
+
+def test_tolerance_pairs_respect_both_limits():
+    rng = np.random.default_rng(1)
+    n = 300
+    days = pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 5, n), unit="D")
+    cents = rng.integers(1000, 1100, n)
+    delivery = delivery_frame(np.arange(n), days, cents)
+    system = system_frame(np.arange(n), days + pd.to_timedelta(rng.integers(-2, 3, n), unit="D"),
+                          cents + rng.integers(-40, 41, n))
+    result = consolidate(delivery, system, value_tolerance=0.3, date_tolerance_days=1)
+    pairs = result[result["Regra"] == "Tolerância"]
+    assert len(pairs) > 0
+    assert ((pairs["Valor Delivery"] - pairs["Valor Sistema"]).abs() <= 0.3 + 1e-9).all()
+    assert ((pairs["Data Delivery"] - pairs["Data Sistema"]).abs() <= pd.Timedelta(days=1)).all()
+    assert (pairs["Discrepância Inicial"] == "Correspondente (tolerância)").all()
+    matched_sales = result["ID Venda Sistema"].dropna()
+    assert matched_sales.is_unique
+
+
+def test_wide_tolerance_with_repeated_values_stays_fast():
+    n = 2000
+    rng = np.random.default_rng(2)
+    delivery = delivery_frame(np.arange(n), ["2025-01-01"] * n, [5000] * n)
+    system = system_frame(np.arange(n), ["2025-01-01"] * n, rng.integers(2900, 7100, n))
+    start = time.perf_counter()
+    result = consolidate(delivery, system, value_tolerance=21.0)
+    assert time.perf_counter() - start < 5
+    assert (result["Discrepância Inicial"] != "Diferença").all()
+
+
+def test_id_pass_pairs_only_hits_within_the_tolerances():
+    # 500 coincide com o NSU de uma venda de outro valor; 600 com uma venda 3 dias depois;
+    # 700 não tem data no delivery, mas o valor bate
+    delivery = delivery_frame(["500", "600", "700"], ["2025-01-01", "2025-01-01", None], [1000, 2000, 3000])
+    system = system_frame([1, 2, 3, 4], ["2025-01-01", "2025-01-01", "2025-01-04", "2025-01-02"],
+                          [9999, 1000, 2000, 3000], nsu=["500", "x", "600", "700"])
+    result = consolidate(delivery, system, value_tolerance=0.05, date_tolerance_days=1,
+                         id_col_delivery="N° PEDIDO IFOOD", id_col_system="NSU")
+    by_order = result[result["Pedido Delivery"].notna()].set_index("Pedido Delivery")
+    assert by_order.loc["500", "ID Venda Sistema"] == 2
+    assert by_order.loc["500", "Regra"] == "Data e valor"
+    assert by_order.loc["600", "Discrepância Inicial"] == "Diferença"
+    assert by_order.loc["700", "ID Venda Sistema"] == 4
+    assert by_order.loc["700", "Regra"] == "Pedido/NSU"
+
+
+def test_id_pass_normalizes_identifiers():
+    delivery = delivery_frame(["00123", " 45.0"], ["2025-01-01", "2025-01-01"], [1000, 1000])
+    system = system_frame([1, 2], ["2025-01-01", "2025-01-01"], [1000, 1000], nsu=["45", "123"])
+    result = consolidate(delivery, system, id_col_delivery="N° PEDIDO IFOOD", id_col_system="NSU")
+    by_order = result.set_index("Pedido Delivery")
+    assert by_order.loc["00123", "ID Venda Sistema"] == 2
+    assert by_order.loc[" 45.0", "ID Venda Sistema"] == 1
+    assert (result["Regra"] == "Pedido/NSU").all()
+
+
+@pytest.mark.parametrize("unit", ["s", "us", "ns"])
+def test_dates_in_any_datetime_unit(unit):
+    delivery = delivery_frame([1, 2], ["2025-01-01", "2025-01-02"], [1000, 2000])
+    delivery["DATA IFOOD"] = delivery["DATA IFOOD"].astype(f"datetime64[{unit}]")
+    system = system_frame([1, 2], ["2025-01-01", "2025-01-03"], [1001, 2000])
+    system["Data_Faturamento"] = system["Data_Faturamento"].astype("datetime64[us]")
+    result = consolidate(delivery, system, value_tolerance=0.05, date_tolerance_days=1)
+    assert (result["Regra"] == "Tolerância").all()
+    assert result["Data Delivery"].dtype == "datetime64[ns]"
+
+
+def test_money_unit_is_explicit():
+    delivery = delivery_frame([1], ["2025-01-01"], [10])
+    system = system_frame([1], ["2025-01-01"], [10])
+    result = consolidate(delivery, system, in_cents=False)
+    assert result["Valor Delivery"].tolist() == [10.0]
+    with pytest.raises(TypeError):
+        consolidate(delivery.astype({"VALOR IFOOD": float}), system)
+
+
+def test_output_is_typed(delivery_df, system_pool, orders):
+    start, end = period(orders)
+    system_df = utils.run_system_query(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=system_pool, cache=False)
+    result = consolidate(delivery_df, system_df, value_tolerance=0.05, date_tolerance_days=1)
+    assert result["Data Delivery"].dtype == "datetime64[ns]"
+    assert result["Valor Sistema"].dtype == float
+    assert str(result["ID Venda Sistema"].dtype) == "Int64"
+    assert list(result["Discrepância Inicial"].cat.categories) == utils.MATCH_STATUSES
+    assert set(statuses_by_order(result)) <= set(utils.MATCH_STATUSES)
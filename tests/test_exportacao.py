@@ -0,0 +1,61 @@
+from io import BytesIO
+
+import pandas as pd
+import pytest
+import xlsxwriter
+
+import utils
+from conftest import EMPRESA, IFOOD, IFOOD_FORMA, consolidate, period
+
+
+@pytest.fixture
+def consolidated(delivery_df, system_pool, orders):
+    start, end = period(orders)
+    system_df = utils.run_system_query(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=system_pool, cache=False)
+    return consolidate(delivery_df, system_df, value_tolerance=0.05, date_tolerance_days=1)
+
+
+def test_sheet_is_written_in_blocks_without_losing_rows():
+    n = 25
+    df = pd.DataFrame({"pedido": pd.array(list(range(n - 1)) + [None], dtype="Int64"),
+                       "data": pd.date_range("2025-01-01", periods=n),
+                       "valor": [10.5] * n,
+                       "status": pd.Categorical(["Diferença"] * n)})
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True, "in_memory": True,
+                                            "default_date_format": "dd/mm/yyyy"})
+    utils._write_sheet(workbook, "Consolidado", df, block_rows=7)
+    workbook.close()
+    sheet = pd.read_excel(BytesIO(output.getvalue()))
+    assert sheet["pedido"].tolist()[:-1] == list(range(n - 1))
+    assert pd.isna(sheet["pedido"].iloc[-1])
+    assert sheet["data"].tolist() == df["data"].tolist()
+    assert sheet["valor"].tolist() == [10.5] * n
+
+
+def test_xlsx_export_has_the_result_and_the_daily_summary(consolidated):
+    with utils.export_consolidated(consolidated, "xlsx") as output:
+        sheets = pd.read_excel(output, sheet_name=None)
+    assert list(sheets) == ["Consolidado", "Resumo"]
+    sheet = sheets["Consolidado"]
+    assert len(sheet) == len(consolidated)
+    assert sheet["Discrepância Inicial"].tolist() == consolidated["Discrepância Inicial"].astype(str).tolist()
+    assert sheet["Valor Sistema"].sum() == pytest.approx(consolidated["Valor Sistema"].sum())
+    summary = utils.build_daily_summary(consolidated)
+    assert sheets["Resumo"]["Diferença (R$)"].tolist() == pytest.approx(summary["Diferença (R$)"].tolist())
+
+
+def test_csv_and_parquet_exports(consolidated):
+    with utils.export_consolidated(consolidated, "csv") as output:
+        csv = pd.read_csv(output, sep=";", decimal=",", encoding="utf-8-sig")
+    assert len(csv) == len(consolidated)
+    assert csv["Valor Delivery"].sum() == pytest.approx(consolidated["Valor Delivery"].sum())
+    assert csv["Data Delivery"].dropna().str.match(r"\d{2}/\d{2}/\d{4}$").all()
+
+    with utils.export_consolidated(consolidated, "parquet") as output:
+        parquet = pd.read_parquet(output)
+    assert parquet["Pedido Delivery"].tolist() == consolidated["Pedido Delivery"].tolist()
+    assert parquet["Data Sistema"].tolist() == consolidated["Data Sistema"].tolist()
+
+    with pytest.raises(ValueError):
+        utils.export_consolidated(consolidated, "ods")
@@ -0,0 +1,117 @@
+import sqlite3
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+import benchmark
+import cli
+import config
+import utils
+from conftest import EMPRESA, period
+
+GOOMER = 709
+PAIRS = [(EMPRESA, 1032), (EMPRESA, GOOMER)]
+
+
+@pytest.fixture
+def batch_inputs(tmp_path):
+    """Planilhas do iFood e do GOOMER da mesma loja e um banco com as vendas dos dois."""
+    path = str(tmp_path / "sistema.db")
+    other = str(tmp_path / "goomer.db")
+    ifood_orders = benchmark.generate_orders(800, seed=11)
+    goomer_orders = benchmark.generate_orders(500, seed=12)
+    benchmark.build_system_db(path, ifood_orders, 1032, 17, seed=11)
+    benchmark.build_system_db(other, goomer_orders, GOOMER, 1, seed=12)
+    conn = sqlite3.connect(path)
+    conn.execute("attach ? as outro", (other,))
+    conn.execute("insert into ContasAReceber select ID_Venda + 100000, ID_Empresa, ID_Caixa, id_origem_caixa, "
+                 "ID_Forma, ID_Cliente, Documento_Cartao, Valor, Emissao, datacadastro from outro.ContasAReceber")
+    conn.execute("insert into FormasPagamento select * from outro.FormasPagamento")
+    conn.execute("insert into Clientes select * from outro.Clientes")
+    conn.commit()
+    conn.close()
+    uploads = {(EMPRESA, 1032): benchmark.write_xlsx(benchmark.delivery_export(ifood_orders, "ifood")),
+               (EMPRESA, GOOMER): benchmark.write_xlsx(benchmark.delivery_export(goomer_orders, "goomer"))}
+    start = min(period(ifood_orders)[0], period(goomer_orders)[0])
+    end = max(period(ifood_orders)[1], period(goomer_orders)[1])
+    return uploads, start, end, benchmark.sqlite_pool(path)
+
+
+def test_batch_matches_each_pair_consolidated_alone(batch_inputs):
+    uploads, start, end, pool = batch_inputs
+    results = utils.consolidate_batch(uploads, start, end, config.delivery_rules, config.delivery_tolerances,
+                                      max_workers=2, pool=pool)
+    assert list(results) == PAIRS
+    for (id_empresa, id_delivery), result in results.items():
+        schema = utils.DELIVERY_SCHEMAS[id_delivery]
+        cols = utils.delivery_output_columns(schema)
+        rules = config.delivery_rules[id_delivery]
+        tolerance = config.delivery_tolerances[id_delivery]
+        system_df = utils.run_system_query(start, end, id_empresa, rules["client_ids"], rules["id_forma"],
+                                           pool=pool, cache=False)
+        delivery_df = utils.process_delivery(BytesIO(uploads[(id_empresa, id_delivery)]), schema)
+        expected = utils.consolidate_data(delivery_df, system_df, cols["Data Delivery"], cols["Valor Delivery"],
+                                          "Data_Faturamento", "Valor Bruto", cols, utils.SYSTEM_OUTPUT_COLUMNS,
+                                          value_tolerance=tolerance["valor"],
+                                          date_tolerance_days=tolerance["dias"])
+        pd.testing.assert_frame_equal(result, expected)
+        assert (result["Discrepância Inicial"] != "Diferença").sum() > 0.9 * len(delivery_df)
+
+
+def test_batch_workbook_has_one_sheet_per_pair(batch_inputs):
+    uploads, start, end, pool = batch_inputs
+    results = utils.consolidate_batch(uploads, start, end, config.delivery_rules, max_workers=1, pool=pool)
+    with utils.build_batch_workbook(results, config.id_empresa_mapping, config.mapping_deliverys) as output:
+        sheets = pd.read_excel(output, sheet_name=None)
+    names = [utils.batch_sheet_name(*pair, config.id_empresa_mapping, config.mapping_deliverys) for pair in PAIRS]
+    assert list(sheets) == names + ["Resumo"]
+    assert [len(sheets[name]) for name in names] == [len(results[pair]) for pair in PAIRS]
+    assert set(sheets["Resumo"]["Aba"]) == set(names)
+
+
+@pytest.fixture
+def cli_dirs(tmp_path, batch_inputs, monkeypatch):
+    """Planilhas no padrão <id_empresa>_<id_delivery>.xlsx e o cli usando o banco SQLite."""
+    uploads, start, end, pool = batch_inputs
+    planilhas = tmp_path / "planilhas"
+    planilhas.mkdir()
+    for (id_empresa, id_delivery), data in uploads.items():
+        (planilhas / f"{id_empresa}_{id_delivery}.xlsx").write_bytes(data)
+    settings = tmp_path / "config.toml"
+    settings.write_text('[mssql]\npool_size = 2\n')
+    monkeypatch.setattr(utils, "get_db_connection", pool.factory)
+    monkeypatch.setattr(utils, "_settings", None)
+    yield planilhas, tmp_path / "saida", settings, start, end
+    utils.configure(None)
+
+
+def cli_args(planilhas, saida, settings, start, end, *extra):
+    return ["--inicio", start.isoformat(), "--fim", end.isoformat(), "--planilhas", str(planilhas),
+            "--saida", str(saida), "--config", str(settings), "--lojas", str(EMPRESA),
+            "--deliverys", "1032", str(GOOMER), "--jobs", "1", *extra]
+
+
+def test_cli_writes_the_batch_workbook(cli_dirs):
+    planilhas, saida, settings, start, end = cli_dirs
+    assert cli.main(cli_args(planilhas, saida, settings, start, end)) == 0
+    path = saida / f"Consolidado_{start:%Y%m%d}_{end:%Y%m%d}.xlsx"
+    sheets = pd.read_excel(path, sheet_name=None)
+    assert len(sheets) == len(PAIRS) + 1
+
+
+def test_cli_writes_one_parquet_per_pair(cli_dirs):
+    planilhas, saida, settings, start, end = cli_dirs
+    assert cli.main(cli_args(planilhas, saida, settings, start, end, "--formato", "parquet")) == 0
+    files = sorted(path.name for path in saida.iterdir())
+    assert files == sorted(f"Consolidado_{id_empresa}_{id_delivery}_{start:%Y%m%d}_{end:%Y%m%d}.parquet"
+                           for id_empresa, id_delivery in PAIRS)
+    df = pd.read_parquet(saida / files[0])
+    assert set(df["Discrepância Inicial"]) <= set(utils.MATCH_STATUSES)
+
+
+def test_cli_fails_without_spreadsheets(cli_dirs, tmp_path):
+    _, saida, settings, start, end = cli_dirs
+    empty = tmp_path / "vazio"
+    empty.mkdir()
+    assert cli.main(cli_args(empty, saida, settings, start, end)) == 1
@@ -0,0 +1,128 @@
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+import xlsxwriter
+
+import benchmark
+import utils
+
+
+def small_workbook():
+    """Planilha com texto, inteiros, decimais, datas e células vazias no meio das linhas."""
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {"in_memory": True})
+    date_format = workbook.add_format({"num_format": "dd/mm/yyyy hh:mm"})
+    sheet = workbook.add_worksheet("Pedidos")
+    sheet.write_row(0, 0, ["Número", "Data Pedido", "Cliente", "Valor (R$)"])
+    rows = [(101, datetime(2025, 1, 1, 12, 30), "Ana", 10.5),
+            (102, datetime(2025, 1, 2, 8, 0), None, 20),
+            (103, None, "Bia", None)]
+    for i, (numero, moment, cliente, valor) in enumerate(rows, start=1):
+        sheet.write_number(i, 0, numero)
+        if moment is not None:
+            sheet.write_datetime(i, 1, moment, date_format)
+        if cliente is not None:
+            sheet.write_string(i, 2, cliente)
+        if valor is not None:
+            sheet.write_number(i, 3, valor)
+    workbook.close()
+    return output.getvalue()
+
+
+def test_read_excel_nostyles_matches_openpyxl():
+    data = small_workbook()
+    expected = pd.read_excel(BytesIO(data))
+    result = utils.read_excel_nostyles(data)
+    # Células vazias vêm como None; o pandas usa NaN
+    pd.testing.assert_frame_equal(result.where(result.notna(), np.nan), expected, check_dtype=False)
+    assert result["Data Pedido"].iloc[0] == pd.Timestamp("2025-01-01 12:30")
+
+
+def test_read_excel_nostyles_keeps_only_usecols():
+    data = small_workbook()
+    result = utils.read_excel_nostyles(BytesIO(data), usecols=["Valor (R$)", "Número"])
+    assert list(result.columns) == ["Número", "Valor (R$)"]
+    assert result["Número"].tolist() == [101, 102, 103]
+
+
+def test_broken_styles_fall_back_to_the_streaming_reader():
+    orders = benchmark.generate_orders(300, seed=7)
+    data = benchmark.write_xlsx(benchmark.delivery_export(orders, "mais_delivery"))
+    broken = benchmark.break_styles(data)
+    with pytest.raises(TypeError):
+        pd.read_excel(BytesIO(broken))
+    schema = utils.DELIVERY_SCHEMAS[1035]
+    pd.testing.assert_frame_equal(utils.process_delivery(BytesIO(broken), schema),
+                                  utils.process_delivery(BytesIO(data), schema))
+
+
+def test_parsed_cache_reuses_the_same_file_and_returns_copies():
+    data = small_workbook()
+    cache = utils.ParsedDeliveryCache()
+    calls = []
+
+    def processor(uploaded_file):
+        calls.append(uploaded_file)
+        return utils.read_excel_nostyles(uploaded_file)
+
+    first = utils.parse_delivery_cached(BytesIO(data), 1035, processor, cache=cache)
+    first.loc[0, "Cliente"] = "alterado"
+    second = utils.parse_delivery_cached(BytesIO(data), 1035, processor, cache=cache)
+    assert len(calls) == 1
+    assert second.loc[0, "Cliente"] == "Ana"
+    # Outro delivery ou outro conteúdo é outra entrada
+    utils.parse_delivery_cached(BytesIO(data), 1205, processor, cache=cache)
+    utils.parse_delivery_cached(BytesIO(data + b"\0"), 1035, lambda f: second, cache=cache)
+    assert len(calls) == 2
+
+
+def test_parsed_cache_evicts_by_count_and_by_size():
+    small = pd.DataFrame({"valor": range(10)})
+    cache = utils.ParsedDeliveryCache(max_entries=2, max_bytes=small.memory_usage(deep=True).sum() * 2)
+    cache.put("a", small)
+    cache.put("b", small)
+    cache.get("a")
+    cache.put("c", small)
+    assert cache.get("b") is None
+    assert cache.get("a") is small and cache.get("c") is small
+    cache.put("grande", pd.DataFrame({"valor": range(1000)}))
+    assert cache.get("grande") is None
+
+
+@pytest.mark.parametrize("delivery, id_delivery", [("ifood", 1032), ("mais_delivery", 1035),
+                                                   ("aiquefome", 1231), ("goomer", 709)])
+def test_each_schema_gives_days_and_cents(delivery, id_delivery):
+    orders = benchmark.generate_orders(200, seed=8)
+    data = benchmark.write_xlsx(benchmark.delivery_export(orders, delivery))
+    schema = utils.DELIVERY_SCHEMAS[id_delivery]
+    df = utils.process_delivery(BytesIO(data), schema)
+    cols = utils.delivery_output_columns(schema)
+    assert df[cols["Pedido Delivery"]].tolist() == orders["numero"].tolist()
+    assert df[cols["Data Delivery"]].tolist() == orders["momento"].dt.normalize().tolist()
+    # No AI QUE FOME o valor do pedido é o total mais o desconto
+    assert df[cols["Valor Delivery"]].tolist() == (orders["valor"] * 100).round().astype("int64").tolist()
+    assert df[cols["Valor Delivery"]].dtype == "int64"
+
+
+def test_aiquefome_keeps_total_and_discount_in_cents():
+    orders = benchmark.generate_orders(50, seed=9)
+    data = benchmark.write_xlsx(benchmark.delivery_export(orders, "aiquefome"))
+    df = utils.process_delivery(BytesIO(data), utils.DELIVERY_SCHEMAS[1231])
+    discount = (orders["desconto"] * 100).round().astype("int64")
+    assert df["Desconto (R$)"].tolist() == discount.tolist()
+    assert (df["Total (R$)"] + df["Desconto (R$)"]).equals(df["Valor AI QUE FOME"])
+    assert utils.delivery_money_columns(utils.DELIVERY_SCHEMAS[1231]) == ["Total (R$)", "Desconto (R$)",
+                                                                          "Valor AI QUE FOME"]
+
+
+def test_goomer_text_columns_are_categories():
+    orders = benchmark.generate_orders(50, seed=10)
+    data = benchmark.write_xlsx(benchmark.delivery_export(orders, "goomer"))
+    df = utils.process_delivery(BytesIO(data), utils.DELIVERY_SCHEMAS[709])
+    assert list(df.columns) == list(utils.GOOMER_SCHEMA["columns"].values())
+    for col in ["CUPOM", "TIPO", "FORMA DE PAGAMENTO"]:
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    assert df["TIPO"].unique().tolist() == ["Delivery"]
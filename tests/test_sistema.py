@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import time
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+import utils
+from conftest import EMPRESA, IFOOD, IFOOD_FORMA, build_system_db, period
+
+
+def query(pool, orders, **kwargs):
+    start, end = period(orders)
+    return utils.run_system_query(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=pool, **kwargs)
+
+
+class Connection:
+    """Conexão SQLite em memória que registra quando é fechada."""
+    def __init__(self, closed):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.closed = closed
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def close(self):
+        self.closed.append(self)
+        self.conn.close()
+
+
+def test_pool_replaces_broken_connections_and_is_bounded():
+    closed = []
+    pool = utils.ConnectionPool(lambda: Connection(closed), max_size=1, timeout=0.1)
+    conn = pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    conn.conn.close()
+    pool.release(conn)
+    replacement = pool.acquire()
+    assert replacement is not conn
+    assert closed == [conn]
+    pool.release(replacement)
+    assert pool.acquire() is replacement
+
+
+def test_configure_closes_the_previous_pool(monkeypatch):
+    closed = []
+    monkeypatch.setattr(utils, "get_db_connection", lambda: Connection(closed))
+    monkeypatch.setattr(utils, "_settings", None)
+    utils.configure({"mssql": {"pool_size": 2}})
+    pool = utils.get_connection_pool()
+    idle, borrowed = pool.acquire(), pool.acquire()
+    pool.release(idle)
+    utils.configure({"mssql": {"pool_size": 3}})
+    assert closed == [idle]
+    pool.release(borrowed)
+    assert closed == [idle, borrowed]
+    assert utils.get_connection_pool() is not pool
+    utils.configure(None)
+
+
+def test_daily_totals_match_the_detail(system_pool, orders):
+    start, end = period(orders)
+    detail = query(system_pool, orders, cache=False)
+    totals = utils.run_system_daily_totals(start, end, EMPRESA, [IFOOD], [IFOOD_FORMA], pool=system_pool)
+    by_billing = utils.daily_totals_by(totals, "faturamento")
+    grouped = detail.groupby("Data_Faturamento")["Valor Bruto"].agg(["count", "sum"])
+    assert by_billing["quantidade"].tolist() == grouped["count"].tolist()
+    assert by_billing["centavos"].tolist() == grouped["sum"].tolist()
+
+
+def test_cache_refetches_days_changed_in_the_database(tmp_path, orders):
+    path = str(tmp_path / "sistema.db")
+    pool = build_system_db(path, orders)
+    cache = utils.SystemQueryCache(disk_dir=str(tmp_path / "cache"))
+    before = query(pool, orders, cache=cache)
+    conn = sqlite3.connect(path)
+    conn.execute("update ContasAReceber set Valor = Valor + 1 where ID_Venda = 10")
+    conn.commit()
+    conn.close()
+    # Em memória e no disco (outro processo, mesmo diretório)
+    assert query(pool, orders, cache=cache)["Valor Bruto"].sum() - before["Valor Bruto"].sum() == 100
+    disk_only = utils.SystemQueryCache(disk_dir=str(tmp_path / "cache"))
+    assert query(pool, orders, cache=disk_only)["Valor Bruto"].sum() - before["Valor Bruto"].sum() == 100
+
+
+def test_cache_expires_and_invalidates_closed_days(tmp_path, system_pool, orders):
+    cache_dir = str(tmp_path / "cache")
+    cache = utils.SystemQueryCache(disk_dir=cache_dir, verify=False)
+    query(system_pool, orders, cache=cache)
+    start, end = period(orders)
+    assert len(os.listdir(cache_dir)) == (end - start).days + 1
+
+    expired = utils.SystemQueryCache(disk_dir=cache_dir, verify=False, closed_ttl=0)
+    time.sleep(1.1)
+    assert expired.get((EMPRESA, (IFOOD,), (IFOOD_FORMA,)), start) is None
+    assert len(os.listdir(cache_dir)) == (end - start).days
+
+    assert cache.invalidate(start, end) > 0
+    assert os.listdir(cache_dir) == []
+    refreshed = query(system_pool, orders, cache=cache, refresh=True)
+    assert len(refreshed) == len(query(system_pool, orders, cache=False))
+
+
+def test_cached_and_fetched_days_combine_like_the_plain_query(system_pool, orders):
+    start, end = period(orders)
+    expected = query(system_pool, orders, cache=False)
+    cache = utils.SystemQueryCache(verify=False)
+    middle = start + timedelta(days=10)
+    utils.run_system_query(middle, middle + timedelta(days=3), EMPRESA, [IFOOD], [IFOOD_FORMA],
+                           pool=system_pool, cache=cache)
+    # Dias do cache no meio de dois intervalos lidos do banco, em lotes pequenos
+    result = query(system_pool, orders, cache=cache, chunksize=300)
+    pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+    assert "Data_Emissao" not in result.columns
+
@@ -1,57 +1,289 @@
-import streamlit as st
 import pandas as pd
+import numpy as np
 import pyodbc
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, date, timedelta
+import os
+import json
+import logging
+import cProfile
+import tracemalloc
 import re
+import hashlib
+import time
+import queue
+import threading
 import zipfile
-from openpyxl import load_workbook
+import tempfile
+import sqlite3
+import xlsxwriter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from xml.etree import ElementTree
+from pandas.api.extensions import take
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.datetime import from_excel, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
 from xlrd.compdoc import CompDocError
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: usa o pacote toml, que já vem com o Streamlit
+    tomllib = None
+    import toml
 
 
+logger = logging.getLogger("app_deliverys")
+
+class ConsolidationError(Exception):
+    """Erro esperado (configuração, banco ou planilha) com mensagem pronta para o usuário."""
+
+class ConsolidationCancelled(ConsolidationError):
+    """A etapa foi interrompida porque outra etapa da mesma consolidação falhou."""
+
+_settings = None
+
+def load_settings(path=None, secrets=None):
+    """
+    Lê as configurações de um arquivo TOML no formato do secrets do Streamlit. O caminho vem de
+    path, da variável APP_DELIVERYS_CONFIG ou, por padrão, de .streamlit/secrets.toml.
+    secrets (o st.secrets da interface), se informado, tem precedência sobre o arquivo, chave a chave.
+    As variáveis MSSQL_SERVER, MSSQL_DATABASE, MSSQL_USERNAME e MSSQL_PASSWORD, se definidas,
+    têm precedência sobre as duas fontes.
+    """
+    path = path or os.environ.get("APP_DELIVERYS_CONFIG", os.path.join(".streamlit", "secrets.toml"))
+    settings = {}
+    if os.path.exists(path):
+        if tomllib is not None:
+            with open(path, "rb") as f:
+                settings = tomllib.load(f)
+        else:
+            settings = toml.load(path)
+    for key, value in (secrets or {}).items():
+        if hasattr(value, "items"):
+            settings[key] = {**settings.get(key, {}), **dict(value)}
+        else:
+            settings[key] = value
+    mssql = dict(settings.get("mssql", {}))
+    for key in ("server", "database", "username", "password"):
+        value = os.environ.get(f"MSSQL_{key.upper()}")
+        if value:
+            mssql[key] = value
+    settings["mssql"] = mssql
+    return settings
+
+def configure(settings):
+    """
+    Define as configurações usadas pelo módulo (a interface passa o st.secrets). Se elas
+    mudarem, o pool e os caches criados com as configurações anteriores são descartados.
+    """
+    global _settings
+    if settings == _settings:
+        return
+    _settings = settings
+    if get_connection_pool.cache_info().currsize:
+        # Fecha as conexões ociosas do pool antigo; as emprestadas são fechadas ao voltar
+        get_connection_pool().close_all()
+    get_connection_pool.cache_clear()
+    get_system_query_cache.cache_clear()
+    get_parsed_delivery_cache.cache_clear()
+    get_reconciliation_ledger.cache_clear()
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
+
 def get_db_connection():
-    # Recuperar as credenciais configuradas via secrets
-    server   = st.secrets["mssql"]["server"]
-    database = st.secrets["mssql"]["database"]
-    username = st.secrets["mssql"]["username"]
-    password = st.secrets["mssql"]["password"]
+    # Recuperar as credenciais configuradas (secrets do Streamlit, arquivo TOML ou variáveis de ambiente)
+    mssql = get_settings().get("mssql", {})
+    server   = mssql.get("server")
+    database = mssql.get("database")
+    username = mssql.get("username")
+    password = mssql.get("password")
     if not all([server, database, username, password]):
-        st.error("Verifique se todas as variáveis estão definidas corretamente no secrets.")
-        st.stop()
+        raise ConsolidationError("Verifique se todas as variáveis estão definidas corretamente no secrets.")
     conn_str = f"DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={server};DATABASE={database};UID={username};PWD={password}"
     try:
         conn = pyodbc.connect(conn_str)
         return conn
     except Exception as e:
-        st.error("Erro na conexão com o banco de dados: " + str(e))
-        st.stop()
-
-def run_system_query(start_date, end_date, id_empresa, client_ids, id_forma_list):
-    conn = get_db_connection()
-    # Formatação das datas
-    start_str = start_date.strftime('%Y-%m-%d 00:00:00')
-    end_str = end_date.strftime('%Y-%m-%d 23:59:59')
-    client_ids_str = ",".join(str(x) for x in client_ids)
-    id_forma_str = ",".join(str(x) for x in id_forma_list)
-    
+        raise ConsolidationError("Erro na conexão com o banco de dados: " + str(e)) from e
+
+class ConnectionPool:
+    """
+    Pool de conexões limitado a max_size conexões simultâneas.
+    As conexões ociosas são reaproveitadas e testadas com health_query antes de voltar ao uso;
+    as que falham são fechadas e substituídas por uma nova criada por factory.
+    factory pode ser qualquer função que devolva uma conexão DB-API (pyodbc, sqlite3, ...).
+    day_sql é a expressão do dialeto do banco que trunca uma data/hora no dia ({} é a data/hora).
+    """
+    def __init__(self, factory, max_size=5, timeout=30, health_query="SELECT 1", day_sql="Cast({} As Date)"):
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_query = health_query
+        self.day_sql = day_sql
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+
+    def _is_healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"Nenhuma conexão livre no pool após {self.timeout}s.")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.factory()
+                if self._is_healthy(conn):
+                    return conn
+                self._close(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        try:
+            if discard or self._closed:
+                self._close(conn)
+            else:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Empresta uma conexão do pool; em caso de erro ela é descartada em vez de devolvida."""
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def close_all(self):
+        """Fecha as conexões ociosas; as que estão emprestadas são fechadas quando devolvidas."""
+        self._closed = True
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+@lru_cache(maxsize=None)
+def get_connection_pool():
+    # O pool, os caches e o histórico são um por processo (lru_cache), compartilhados entre todas
+    # as sessões do Streamlit; configure() os descarta quando as configurações mudam
+    max_size = int(get_settings().get("mssql", {}).get("pool_size", 5))
+    return ConnectionPool(get_db_connection, max_size=max_size)
+
+# Colunas de texto repetitivo do sistema, guardadas como category
+SYSTEM_CATEGORY_COLUMNS = ['Forma de Pagamento', 'Nome', 'RazaoCliente']
+
+def to_day(series, dayfirst=False):
+    """
+    Converte a coluna em datetime64[ns] com resolução de dia (horário zerado); o que não for data
+    vira NaT. A unidade é sempre ns, para que colunas vindas em [s] ou [us] possam ser comparadas
+    e combinadas (merge_asof) com as demais.
+    """
+    return pd.to_datetime(series, dayfirst=dayfirst, errors='coerce').dt.normalize().astype('datetime64[ns]')
+
+def to_cents(series):
+    """Converte valores em R$ para centavos em int64, arredondando; o que não for número vira 0."""
+    values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    return pd.Series(np.round(np.nan_to_num(values) * 100).astype(np.int64), index=series.index)
+
+def _categorize(df, columns):
+    for col in columns:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+def _convert_system_types(df):
+    # As colunas já chegam tipadas; to_datetime só garante o tipo para drivers que devolvem texto
+    df['Data_Faturamento'] = to_day(df['Data_Faturamento'])
+    df['Data_Emissao'] = to_day(df['Data_Emissao'])
+    df['Valor Bruto'] = to_cents(df['Valor Bruto'])
+    return _categorize(df, SYSTEM_CATEGORY_COLUMNS)
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise ConsolidationCancelled("Consulta ao sistema cancelada.")
+
+# Datas da consulta de vendas: a emissão filtra o período e separa o cache por dia; o
+# faturamento é a data usada na correspondência (Data_Faturamento)
+_SQL_EMISSION_DATE = "Coalesce(CA.Emissao, VS.Data_Faturamento)"
+_SQL_BILLING_DATE = "Coalesce(VS.Data_Faturamento, CA.datacadastro)"
+
+def iter_system_query(start_date, end_date, id_empresa, client_ids, id_forma_list, pool,
+                      chunksize=50000, cancel_event=None):
+    """
+    Executa a consulta de vendas no banco para o período informado (sem cache) e devolve o
+    resultado em lotes de até chunksize linhas, já convertidos, lidos do cursor com fetchmany.
+    Assim a memória ocupada pelas linhas cruas do driver fica limitada a um lote por vez.
+    Data_Emissao traz a data usada no filtro do período, para separar o resultado por dia.
+    Datas e listas de ids vão como parâmetros, para que o plano da consulta seja reaproveitado,
+    e valor e datas voltam nos tipos nativos (decimal/datetime), sem FORMAT no servidor.
+    Cada lote sai com as datas em datetime64 (dia), 'Valor Bruto' em centavos (int64) e as
+    colunas de SYSTEM_CATEGORY_COLUMNS como category.
+    id_empresa pode ser um id ou uma lista de ids (consulta agrupada de várias lojas).
+    Se cancel_event (threading.Event) for acionado, a leitura para no próximo lote com
+    ConsolidationCancelled e a conexão é descartada.
+    """
+    from_where, params = _system_query_filters(start_date, end_date, id_empresa, client_ids, id_forma_list)
     query = f"""
     Select
         CA.ID_Venda,
+        CA.ID_Empresa,
         FP.Descricao [Forma de Pagamento],
         U.Nome,
         CA.ID_Caixa,
         FP.ID_Forma,
         CA.Documento_Cartao NSU,
-        Replace(Convert(Varchar,Convert(Decimal(18,2),CA.Valor)),'.',',') [Valor Bruto],
-        case when format(VS.Data_Faturamento, 'dd/MM/yyyy') is null 
-             then format(CA.datacadastro, 'dd/MM/yyyy') 
-             else format(VS.Data_Faturamento, 'dd/MM/yyyy') end as Data_Faturamento1,
-        case when VS.Data_Faturamento is null 
-             then CA.datacadastro 
-             else VS.Data_Faturamento end as Data_Faturamento,
+        Cast(CA.Valor As Decimal(18,2)) [Valor Bruto],
+        {_SQL_BILLING_DATE} as Data_Faturamento,
+        {_SQL_EMISSION_DATE} as Data_Emissao,
         c.ID_Cliente, 
         c.RazaoCliente
-    From ContasAReceber CA
+    {from_where}
+    Order By FP.ID_Forma, CA.Valor, E.NomeFantasia, Coalesce(VS.Data_Faturamento, CA.Emissao)
+    """
+    with pool.connection() as conn:
+        for chunk in pd.read_sql(query, conn, params=params, chunksize=chunksize):
+            _check_cancelled(cancel_event)
+            yield _convert_system_types(chunk)
+
+def _system_query_filters(start_date, end_date, id_empresa, client_ids, id_forma_list):
+    """
+    Trecho From/Where da consulta de vendas (comum ao detalhe e aos totais por dia) e os seus
+    parâmetros. O período é filtrado pela data de emissão.
+    """
+    empresa_ids = list(id_empresa) if isinstance(id_empresa, (list, tuple, set)) else [id_empresa]
+    empresa_marks = ",".join("?" for _ in empresa_ids)
+    client_marks = ",".join("?" for _ in client_ids)
+    forma_marks = ",".join("?" for _ in id_forma_list)
+    from_where = f"""From ContasAReceber CA
     left Join FormasPagamento FP On FP.ID_Forma = CA.ID_Forma
     inner Join Fechamento_Caixas FC On
             FC.ID_Empresa = CA.ID_Empresa And
@@ -65,243 +297,1559 @@ def run_system_query(start_date, end_date, id_empresa, client_ids, id_forma_list
     inner join Clientes C on CA.ID_Cliente = C.ID_Cliente
     Where CA.ID_Forma In (1,31,5,6,17,18,37)
       And E.TipoEmpresa = 'Sorveteria'
-      And IsNull(CA.Emissao, VS.Data_Faturamento) >= '{start_str}'
-      And IsNull(CA.Emissao, VS.Data_Faturamento) <= '{end_str}'
-      and E.ID_Empresa in ({id_empresa})
+      And {_SQL_EMISSION_DATE} >= ?
+      And {_SQL_EMISSION_DATE} < ?
+      and E.ID_Empresa in ({empresa_marks})
       and ca.ID_Origem_Caixa = 1
-      and c.ID_Cliente in ({client_ids_str})
-      and FP.ID_Forma in ({id_forma_str})
-    Order By FP.ID_Forma, CA.Valor, E.NomeFantasia, IsNull(VS.Data_Faturamento, CA.Emissao)
-    """
-    df = pd.read_sql(query, conn)
-    # Converter a coluna de data e ajustar o valor bruto
-    df['Data_Faturamento'] = pd.to_datetime(df['Data_Faturamento'], errors='coerce').dt.date
-    df['Valor Bruto'] = df['Valor Bruto'].str.replace(',', '.', regex=False)
-    df['Valor Bruto'] = pd.to_numeric(df['Valor Bruto'], errors='coerce').fillna(0)
-    return df
+      and c.ID_Cliente in ({client_marks})
+      and FP.ID_Forma in ({forma_marks})"""
+    # Período: do início do primeiro dia até antes do início do dia seguinte ao último
+    start_dt = datetime(start_date.year, start_date.month, start_date.day)
+    end_dt = datetime(end_date.year, end_date.month, end_date.day) + timedelta(days=1)
+    params = ([start_dt, end_dt] + [int(x) for x in empresa_ids] + [int(x) for x in client_ids]
+              + [int(x) for x in id_forma_list])
+    return from_where, params
+
+def run_system_daily_totals(start_date, end_date, id_empresa, client_ids, id_forma_list, pool=None):
+    """
+    Totais das vendas do período agrupados no servidor por dia de emissão e dia de faturamento:
+    quantidade, soma (em centavos) e soma dos quadrados dos valores (em R$). Retorna um DataFrame
+    com as colunas 'emissao' e 'faturamento' (datetime64), 'quantidade', 'centavos' e 'quadrados',
+    uma linha por par de dias com vendas; daily_totals_by soma por uma das duas datas.
+    """
+    if pool is None:
+        pool = get_connection_pool()
+    from_where, params = _system_query_filters(start_date, end_date, id_empresa, client_ids, id_forma_list)
+    emission = pool.day_sql.format(_SQL_EMISSION_DATE)
+    billing = pool.day_sql.format(_SQL_BILLING_DATE)
+    query = f"""
+    Select
+        {emission} as Emissao,
+        {billing} as Faturamento,
+        Count(*) as Quantidade,
+        Sum(Cast(CA.Valor As Decimal(18,2))) as Total,
+        Sum(Cast(CA.Valor As Float) * Cast(CA.Valor As Float)) as Quadrados
+    {from_where}
+    Group By {emission}, {billing}
+    """
+    with pool.connection() as conn:
+        df = pd.read_sql(query, conn, params=params)
+    return pd.DataFrame({
+        'emissao': to_day(df['Emissao']),
+        'faturamento': to_day(df['Faturamento']),
+        'quantidade': df['Quantidade'].astype(np.int64),
+        'centavos': to_cents(df['Total']),
+        'quadrados': pd.to_numeric(df['Quadrados']).astype(float),
+    })
+
+def daily_totals_by(system_totals, column):
+    """
+    Soma os totais de run_system_daily_totals por 'emissao' ou 'faturamento', no formato
+    indexado pelo dia usado por mismatched_days. Vendas sem essa data ficam de fora.
+    """
+    return (system_totals.groupby(column)[['quantidade', 'centavos', 'quadrados']].sum()
+            .rename_axis('dia'))
+
+def _stack_columns(parts, sort_by=None):
+    """
+    Monta um DataFrame a partir das partes de cada coluna ({coluna: [Series, ...]}), uma coluna
+    por vez, soltando as partes de cada coluna assim que ela fica pronta. Com sort_by, as linhas
+    saem nessa ordem (estável), também reordenadas coluna a coluna. As colunas não são
+    consolidadas em blocos, para não copiar o resultado inteiro mais uma vez.
+    """
+    columns = {}
+    for col in list(parts):
+        pieces = parts.pop(col)
+        values = pd.concat(pieces, ignore_index=True, copy=False)
+        if isinstance(pieces[0].dtype, pd.CategoricalDtype) and not isinstance(values.dtype, pd.CategoricalDtype):
+            # Partes com categorias diferentes voltam a object no concat
+            values = values.astype('category')
+        del pieces
+        columns[col] = values.array
+    if sort_by is not None:
+        order = np.lexsort([np.asarray(columns[col]) for col in reversed(sort_by)])
+        for col in columns:
+            columns[col] = columns[col].take(order)
+    return pd.DataFrame(columns, copy=False)
+
+def _query_system_range(start_date, end_date, id_empresa, client_ids, id_forma_list, pool,
+                        chunksize=50000, cancel_event=None, sort_by=None):
+    """
+    Executa a consulta em lotes e junta os lotes já convertidos num único DataFrame
+    (ver _stack_columns), com o pico de memória perto de um resultado mais um lote.
+    """
+    parts = {}
+    for chunk in iter_system_query(start_date, end_date, id_empresa, client_ids, id_forma_list,
+                                   pool, chunksize=chunksize, cancel_event=cancel_event):
+        for col in chunk.columns:
+            # Cópia só da coluna, para que nada do lote fique preso depois da iteração
+            parts.setdefault(col, []).append(chunk[col].copy())
+        del chunk
+    return _stack_columns(parts, sort_by=sort_by)
+
+class SystemQueryCache:
+    """
+    Cache por dia dos resultados da consulta do sistema, com chave
+    (ID_Empresa, client_ids, id_forma, dia).
+    Em memória os dias expiram após ttl segundos (closed_ttl para os dias já fechados, anteriores
+    a closed_after_days dias atrás) e, passando de max_days entradas, os menos usados são
+    descartados. Se disk_dir for informado, os dias fechados também são gravados em Parquet e
+    sobrevivem ao reinício, até closed_ttl segundos. Com verify, run_system_query confere os dias
+    do cache com os totais do banco antes de reaproveitá-los (ver _stale_cached_days).
+    """
+    def __init__(self, ttl=600, max_days=2000, disk_dir=None, closed_after_days=2, closed_ttl=86400,
+                 verify=True):
+        self.ttl = ttl
+        self.max_days = max_days
+        self.disk_dir = disk_dir
+        self.closed_after_days = closed_after_days
+        self.closed_ttl = closed_ttl
+        self.verify = verify
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _is_closed(self, day):
+        return day <= date.today() - timedelta(days=self.closed_after_days)
+
+    def _disk_path(self, key, day):
+        id_empresa, client_ids, id_forma = key
+        # O sufixo muda quando os tipos das colunas mudam, para não reaproveitar arquivos antigos
+        name = "{}_{}_{}_{}_centavos.parquet".format(id_empresa, "-".join(map(str, client_ids)),
+                                            "-".join(map(str, id_forma)), day.isoformat())
+        return os.path.join(self.disk_dir, name)
+
+    def get(self, key, day):
+        ttl = self.closed_ttl if self._is_closed(day) else self.ttl
+        with self._lock:
+            entry = self._mem.get((key, day))
+            if entry is not None:
+                stored_at, df = entry
+                if time.monotonic() - stored_at <= ttl:
+                    self._mem.move_to_end((key, day))
+                    return df
+                del self._mem[(key, day)]
+        if self.disk_dir and self._is_closed(day):
+            path = self._disk_path(key, day)
+            if os.path.exists(path):
+                if time.time() - os.path.getmtime(path) > ttl:
+                    os.remove(path)
+                    return None
+                df = pd.read_parquet(path)
+                self._remember(key, day, df)
+                return df
+        return None
+
+    def _remember(self, key, day, df):
+        with self._lock:
+            self._mem[(key, day)] = (time.monotonic(), df)
+            self._mem.move_to_end((key, day))
+            while len(self._mem) > self.max_days:
+                self._mem.popitem(last=False)
+
+    def put(self, key, day, df):
+        self._remember(key, day, df)
+        if self.disk_dir and self._is_closed(day):
+            df.to_parquet(self._disk_path(key, day), index=False)
+
+    def invalidate(self, start_date, end_date, key=None):
+        """
+        Descarta, em memória e no disco, os dias de start_date a end_date (de todas as chaves ou
+        só de key). Retorna quantas entradas foram removidas.
+        """
+        removed = 0
+        with self._lock:
+            for entry_key, day in list(self._mem):
+                if start_date <= day <= end_date and key in (None, entry_key):
+                    del self._mem[(entry_key, day)]
+                    removed += 1
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                match = re.match(r"(\d+)_([\d-]*)_([\d-]*)_(\d{4}-\d{2}-\d{2})_centavos\.parquet$", name)
+                if match is None:
+                    continue
+                if key is not None and match.groups()[:3] != (str(key[0]), "-".join(map(str, key[1])),
+                                                               "-".join(map(str, key[2]))):
+                    continue
+                if start_date <= date.fromisoformat(match.group(4)) <= end_date:
+                    os.remove(os.path.join(self.disk_dir, name))
+                    removed += 1
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+
+@lru_cache(maxsize=None)
+def get_system_query_cache():
+    config = get_settings().get("cache", {})
+    return SystemQueryCache(ttl=int(config.get("ttl", 600)),
+                            max_days=int(config.get("max_days", 2000)),
+                            disk_dir=config.get("dir"),
+                            closed_ttl=int(config.get("closed_ttl", 86400)),
+                            verify=bool(config.get("verify", True)))
+
+def _frame_daily_totals(df, date_col, value_col):
+    """
+    Totais por dia (quantidade, centavos e soma dos quadrados em R$) de um DataFrame com valores
+    em centavos, no formato de run_system_daily_totals. Linhas sem data ficam de fora.
+    """
+    cents = df[value_col].to_numpy(dtype=np.int64)
+    frame = pd.DataFrame({'dia': to_day(df[date_col]).to_numpy(), 'quantidade': 1,
+                          'centavos': cents, 'quadrados': (cents / 100) ** 2})
+    return frame.dropna(subset=['dia']).groupby('dia').sum()
+
+def _stale_cached_days(frames, key, pool):
+    """
+    Dias do cache cujos totais (quantidade, soma e soma dos quadrados) não batem mais com os do
+    banco, obtidos numa única consulta agrupada (run_system_daily_totals) do primeiro ao último dia.
+    Assim uma venda corrigida no sistema não continua vindo do cache.
+    """
+    days = sorted(frames)
+    id_empresa, client_ids, id_forma = key
+    server = daily_totals_by(run_system_daily_totals(days[0], days[-1], id_empresa, list(client_ids),
+                                                     list(id_forma), pool=pool), 'emissao')
+    # Só as duas colunas usadas nos totais, sem copiar os dias inteiros do cache
+    cached = _frame_daily_totals(pd.concat([frames[day][['Data_Emissao', 'Valor Bruto']] for day in days],
+                                           ignore_index=True), 'Data_Emissao', 'Valor Bruto')
+    differing = set(pd.DatetimeIndex(mismatched_days(cached, server)).date)
+    return [day for day in days if day in differing]
+
+def _contiguous_ranges(days):
+    """Agrupa uma lista ordenada de dias em intervalos (início, fim) de dias consecutivos."""
+    ranges = []
+    for day in days:
+        if ranges and day == ranges[-1][1] + timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(r) for r in ranges]
+
+def run_system_query(start_date, end_date, id_empresa, client_ids, id_forma_list, pool=None, cache=None,
+                     chunksize=50000, cancel_event=None, refresh=False):
+    """
+    Consulta as vendas do sistema no período. Usa o pool compartilhado, a menos que outro
+    ConnectionPool seja informado em pool.
+    Os resultados ficam em cache por dia: só os dias ausentes ou expirados do cache são
+    consultados no banco (agrupados em intervalos contínuos) e o restante é reaproveitado,
+    depois de conferido com os totais do banco se o cache tiver verify. Passe cache=False para
+    ignorar o cache, ou refresh=True para consultar todos os dias de novo e atualizar o cache.
+    Os dias ausentes são lidos do banco em lotes de chunksize linhas (ver iter_system_query);
+    cancel_event permite interromper a leitura entre um lote e outro.
+    """
+    if pool is None:
+        pool = get_connection_pool()
+    if cache is None:
+        cache = get_system_query_cache()
+    days = list(pd.date_range(start_date, end_date, freq='D').date)
+    if cache is False or not days:
+        df = _query_system_range(start_date, end_date, id_empresa, client_ids, id_forma_list, pool,
+                                 chunksize=chunksize, cancel_event=cancel_event)
+        del df['Data_Emissao']
+        return df
+
+    key = (int(id_empresa), tuple(sorted(client_ids)), tuple(sorted(id_forma_list)))
+    frames = {}
+    missing = []
+    for day in days:
+        cached = None if refresh else cache.get(key, day)
+        if cached is None:
+            missing.append(day)
+        else:
+            frames[day] = cached
+    if frames and cache.verify:
+        stale = _stale_cached_days(frames, key, pool)
+        for day in stale:
+            del frames[day]
+        if stale:
+            logger.info(json.dumps({"cache_desatualizado": f"{key[0]}", "dias": [day.isoformat() for day in stale]}))
+            missing = sorted(missing + stale)
+    for first, last in _contiguous_ranges(missing):
+        _check_cancelled(cancel_event)
+        # Em ordem de emissão (estável), cada dia é uma fatia do resultado lido, sem cópia
+        fetched = _query_system_range(first, last, id_empresa, client_ids, id_forma_list, pool,
+                                      chunksize=chunksize, cancel_event=cancel_event, sort_by=['Data_Emissao'])
+        bounds = fetched['Data_Emissao'].searchsorted(pd.date_range(first, last + timedelta(days=1), freq='D'))
+        for day, lo, hi in zip(pd.date_range(first, last, freq='D').date, bounds[:-1], bounds[1:]):
+            day_df = fetched.iloc[lo:hi]
+            cache.put(key, day, day_df)
+            frames[day] = day_df
+        del fetched
+
+    non_empty = [frames[day] for day in days if len(frames[day])]
+    if not non_empty:
+        return frames[days[0]].drop(columns=['Data_Emissao'])
+    # Mesma ordenação da consulta original
+    parts = {col: [frame[col] for frame in non_empty] for col in non_empty[0].columns if col != 'Data_Emissao'}
+    return _stack_columns(parts, sort_by=['ID_Forma', 'Valor Bruto'])
+
+# Colunas do sistema no resultado da consolidação
+SYSTEM_OUTPUT_COLUMNS = {
+    'ID Venda Sistema': 'ID_Venda',
+    'Data Sistema': 'Data_Faturamento',
+    'Valor Sistema': 'Valor Bruto'
+}
+
+# Valores da coluna 'Discrepância Inicial'
+MATCH_STATUSES = ['Correspondente', 'Correspondente (tolerância)', 'Diferença']
+# Valores da coluna 'Regra': qual passada formou o par
+MATCH_RULES = ['Pedido/NSU', 'Data e valor', 'Tolerância', 'Histórico', 'Totais do dia']
+
+def _as_cents(series, in_cents=True):
+    """
+    Valores em centavos (int64). Com in_cents, a coluna já deve estar em centavos inteiros (como
+    saem de process_delivery e run_system_query); sem, os valores são lidos como R$ (parse_money).
+    A unidade é sempre declarada por quem chama: inteiros em R$ não são confundidos com centavos.
+    """
+    if not in_cents:
+        return parse_money(series)
+    if not pd.api.types.is_integer_dtype(series.dtype):
+        raise TypeError(f"A coluna {series.name!r} deveria estar em centavos (inteiros), mas é {series.dtype}; "
+                        "use in_cents=False para valores em R$.")
+    return series.astype(np.int64)
+
+def normalize_ids(series):
+    """
+    Normaliza números de pedido, NSU e ID_Venda para texto comparável: sem espaços, sem o '.0'
+    de números lidos como float, sem zeros à esquerda e em maiúsculas ('00123.0' e 123 viram
+    '123'). Nulos e vazios viram None.
+    """
+    keys = (series.astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+            .str.replace(r'^0+(?=.)', '', regex=True).str.upper())
+    return keys.where(series.notna() & (keys != ''), None)
+
+def _id_pairs(delivery_df, system_df, id_col_delivery, id_col_system):
+    """
+    Passada por identificador: indexa (hash join do merge) o pedido do delivery e o NSU do
+    sistema já normalizados e pareia os que coincidem; a k-ésima repetição de um identificador
+    casa com a k-ésima do outro lado. Retorna as posições pareadas do delivery e do sistema.
+    """
+    keys = []
+    for df, col in ((delivery_df, id_col_delivery), (system_df, id_col_system)):
+        side = pd.DataFrame({'_id': normalize_ids(df[col]).to_numpy(), '_pos': np.arange(len(df))}).dropna()
+        side['_ordem'] = side.groupby('_id', sort=False).cumcount()
+        keys.append(side)
+    pairs = keys[0].merge(keys[1], on=['_id', '_ordem'], suffixes=('_d', '_s'))
+    return pairs['_pos_d'].to_numpy(), pairs['_pos_s'].to_numpy()
+
+def _match_keys(df, date_col, value_col, positions=None):
+    """
+    Monta as chaves de correspondência (data, valor, ordem) das linhas em positions (todas, se
+    não informadas). A ordem é o número da ocorrência do par (data, valor) dentro do próprio
+    DataFrame, de modo que a k-ésima linha do delivery com uma chave case com a k-ésima do sistema.
+    Linhas sem data ou sem valor nunca são correspondidas.
+    """
+    if positions is None:
+        positions = np.arange(len(df))
+    keys = pd.DataFrame({'_data': df[date_col].to_numpy()[positions], '_valor': df[value_col].to_numpy()[positions]})
+    keys['_pos'] = positions
+    keys = keys.dropna(subset=['_data', '_valor'])
+    keys['_ordem'] = keys.groupby(['_data', '_valor'], sort=False).cumcount()
+    return keys
+
+def _take_output_columns(df, col_map, positions):
+    """
+    Seleciona as colunas de saída de df nas posições informadas, mantendo o tipo de cada uma
+    (datas em datetime64, category, inteiros anuláveis). Posição -1 (sem correspondência) vira nulo.
+    As colunas de valor, em centavos, saem em R$.
+    """
+    out = {}
+    for new_col, orig_col in col_map.items():
+        if orig_col not in df.columns:
+            out[new_col] = np.full(len(positions), None, dtype=object)
+            continue
+        col = df[orig_col]
+        if 'valor' in new_col.lower():
+            cents = col.to_numpy(dtype=float, na_value=np.nan)
+            out[new_col] = take(cents, positions, allow_fill=True) / 100
+            continue
+        if pd.api.types.is_integer_dtype(col.dtype):
+            # Inteiro anulável, para que o nulo da posição -1 não transforme o número em float
+            col = col.astype('Int64')
+        values = col.array if isinstance(col.dtype, pd.api.extensions.ExtensionDtype) else col.to_numpy()
+        out[new_col] = take(values, positions, allow_fill=True)
+    return out
+
+def _tolerance_keys(df, date_col, value_col, positions):
+    """
+    Chaves da passada com tolerância: data (datetime64), valor em centavos e posição da linha.
+    """
+    keys = pd.DataFrame({
+        '_data': df[date_col].to_numpy()[positions],
+        '_cents': df[value_col].to_numpy()[positions],
+        '_pos': positions,
+    })
+    return keys.dropna(subset=['_data'])
+
+def _nearest_pairs(d_keys, s_keys, tolerance_cents):
+    """
+    Cada pedido procura, com um merge_asof ordenado pelo valor em centavos, a venda da mesma
+    data com o valor mais próximo dentro da tolerância. Pedidos que disputam a mesma
+    (data, valor) são distribuídos entre as vendas com essa chave pela ordem de distância;
+    os que sobram ficam sem par. Retorna as posições pareadas do delivery e do sistema.
+    """
+    right = s_keys[['_data', '_cents']].drop_duplicates().sort_values('_cents')
+    right['_cents_s'] = right['_cents']
+    cand = pd.merge_asof(d_keys.sort_values('_cents'), right, on='_cents', by='_data', direction='nearest',
+                         tolerance=tolerance_cents).dropna(subset=['_cents_s'])
+    cand['_cents_s'] = cand['_cents_s'].astype(np.int64)
+    cand['_dist'] = (cand['_cents'] - cand['_cents_s']).abs()
+    cand = cand.sort_values(['_dist', '_pos'], kind='stable')
+    cand['_ordem'] = cand.groupby(['_data', '_cents_s'], sort=False).cumcount()
+    supply = s_keys.sort_values('_pos').rename(columns={'_cents': '_cents_s'})
+    supply['_ordem'] = supply.groupby(['_data', '_cents_s'], sort=False).cumcount()
+    pairs = cand[['_data', '_cents_s', '_ordem', '_pos']].merge(
+        supply, on=['_data', '_cents_s', '_ordem'], suffixes=('_d', '_s'))
+    return pairs['_pos_d'].to_numpy(), pairs['_pos_s'].to_numpy()
+
+def _sorted_greedy_pairs(d_keys, s_keys, tolerance_cents):
+    """
+    Pareamento guloso numa única passada, com dois ponteiros sobre as chaves ordenadas por
+    (data, centavos): o menor pedido livre casa com a menor venda livre da mesma data cuja
+    diferença esteja dentro da tolerância. Dá o maior número possível de pares em O(n log n).
+    Retorna as posições pareadas do delivery e do sistema.
+    """
+    d_keys = d_keys.sort_values(['_data', '_cents', '_pos'])
+    s_keys = s_keys.sort_values(['_data', '_cents', '_pos'])
+    d_day, d_cents, d_pos = (d_keys['_data'].to_numpy().view(np.int64).tolist(),
+                             d_keys['_cents'].tolist(), d_keys['_pos'].tolist())
+    s_day, s_cents, s_pos = (s_keys['_data'].to_numpy().view(np.int64).tolist(),
+                             s_keys['_cents'].tolist(), s_keys['_pos'].tolist())
+    d_matched, s_matched = [], []
+    i = j = 0
+    while i < len(d_day) and j < len(s_day):
+        if d_day[i] != s_day[j]:
+            if d_day[i] < s_day[j]:
+                i += 1
+            else:
+                j += 1
+            continue
+        diff = d_cents[i] - s_cents[j]
+        if diff > tolerance_cents:
+            j += 1
+        elif diff < -tolerance_cents:
+            i += 1
+        else:
+            d_matched.append(d_pos[i])
+            s_matched.append(s_pos[j])
+            i += 1
+            j += 1
+    return np.array(d_matched, dtype=np.int64), np.array(s_matched, dtype=np.int64)
+
+def _pair_differences(delivery_df, system_df, date_col_delivery, value_col_delivery,
+                      date_col_system, value_col_system, pos_d, pos_s, value_tolerance, date_tolerance_days):
+    """
+    Diferença de valor (centavos) dos pares já formados (posições pos_d x pos_s) e se cada par
+    está dentro de value_tolerance (R$) e date_tolerance_days.
+    """
+    diff = np.abs(delivery_df[value_col_delivery].to_numpy()[pos_d] - system_df[value_col_system].to_numpy()[pos_s])
+    day_gap = np.abs(delivery_df[date_col_delivery].to_numpy()[pos_d] - system_df[date_col_system].to_numpy()[pos_s])
+    # Sem data de um dos lados a distância em dias é NaT e só o valor decide
+    accepted = (diff <= round(value_tolerance * 100)) & ~(day_gap > np.timedelta64(date_tolerance_days, 'D'))
+    return diff, accepted
+
+def _tolerance_pairs(delivery_df, system_df, date_col_delivery, value_col_delivery,
+                     date_col_system, value_col_system, delivery_free, system_free,
+                     value_tolerance, date_tolerance_days):
+    """
+    Segunda passada de correspondência, apenas entre as linhas que sobraram da passada exata.
+    Para cada deslocamento de dias (0, +1, -1, ..., ±date_tolerance_days), primeiro cada pedido
+    fica com a venda de valor mais próximo dentro de value_tolerance (_nearest_pairs); os que
+    perderam a disputa por uma venda passam por um pareamento guloso ordenado (_sorted_greedy_pairs).
+    São duas passadas fixas por deslocamento, qualquer que seja a tolerância.
+    Retorna as posições pareadas do delivery e do sistema.
+    """
+    tolerance_cents = int(round(value_tolerance * 100))
+    d_keys = _tolerance_keys(delivery_df, date_col_delivery, value_col_delivery, delivery_free)
+    s_keys = _tolerance_keys(system_df, date_col_system, value_col_system, system_free)
+    offsets = [0] + [sign * days for days in range(1, date_tolerance_days + 1) for sign in (1, -1)]
+    d_matched, s_matched = [], []
+    for offset in offsets:
+        for pair_up in (_nearest_pairs, _sorted_greedy_pairs):
+            if d_keys.empty or s_keys.empty:
+                break
+            # Data esperada no sistema para cada pedido: o delivery registra offset dias depois
+            shifted = d_keys.assign(_data=d_keys['_data'] - pd.Timedelta(days=offset))
+            pos_d, pos_s = pair_up(shifted, s_keys, tolerance_cents)
+            d_matched.append(pos_d)
+            s_matched.append(pos_s)
+            d_keys = d_keys[~d_keys['_pos'].isin(pos_d)]
+            s_keys = s_keys[~s_keys['_pos'].isin(pos_s)]
+    if not d_matched:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(d_matched).astype(np.int64), np.concatenate(s_matched).astype(np.int64)
 
 def consolidate_data(delivery_df, system_df, date_col_delivery, value_col_delivery,
-                     date_col_system, value_col_system, order_delivery_cols, order_system_cols):
+                     date_col_system, value_col_system, order_delivery_cols, order_system_cols,
+                     value_tolerance=0.0, date_tolerance_days=0, id_col_delivery=None, id_col_system=None,
+                     in_cents=True):
     """
     Consolida os dados da planilha do delivery com os dados do sistema com base na correspondência
     por data e valor.
     order_delivery_cols e order_system_cols são dicionários que mapeiam o nome das colunas no output.
+    Os valores vêm em centavos (ou em R$ com in_cents=False); as linhas que sobrarem passam por
+    value_tolerance (R$) e date_tolerance_days. Com id_col_delivery e id_col_system os pedidos são
+    pareados antes pelo identificador (ex.: pedido x NSU), dentro das mesmas tolerâncias.
     """
-    # Converter e normalizar as datas
-    delivery_df[date_col_delivery] = pd.to_datetime(delivery_df[date_col_delivery], dayfirst=True, errors='coerce').dt.date
-    system_df[date_col_system] = pd.to_datetime(system_df[date_col_system], errors='coerce').dt.date
+    delivery_df = delivery_df.copy()
+    system_df = system_df.copy()
+    # Normalizar datas (dia) e valores (centavos)
+    delivery_df[date_col_delivery] = to_day(delivery_df[date_col_delivery], dayfirst=True)
+    system_df[date_col_system] = to_day(system_df[date_col_system])
+    delivery_df[value_col_delivery] = _as_cents(delivery_df[value_col_delivery], in_cents)
+    system_df[value_col_system] = _as_cents(system_df[value_col_system], in_cents)
 
     delivery_df.sort_values(by=[date_col_delivery, value_col_delivery], inplace=True)
     system_df.sort_values(by=[date_col_system, value_col_system], inplace=True)
     delivery_df.reset_index(drop=True, inplace=True)
     system_df.reset_index(drop=True, inplace=True)
 
-    system_df['Matched'] = False
-    results = []
-    # Realiza a correspondência dos registros
-    for i, d_row in delivery_df.iterrows():
-        condition = (system_df[date_col_system] == d_row[date_col_delivery]) & \
-                    (system_df[value_col_system] == d_row[value_col_delivery]) & \
-                    (~system_df['Matched'])
-        match = system_df[condition]
-        if not match.empty:
-            matched_row = match.iloc[0]
-            results.append((d_row, matched_row, 'Correspondente'))
-            system_df.loc[matched_row.name, 'Matched'] = True
-        else:
-            results.append((d_row, pd.Series(), 'Diferença'))
-    for j, s_row in system_df.iterrows():
-        if not s_row['Matched']:
-            results.append((pd.Series(), s_row, 'Diferença'))
-    
-    consolidated_list = []
-    for d_row, s_row, status in results:
-        row_dict = {}
-        # Preenche as colunas vindas da planilha do delivery
-        for new_col, orig_col in order_delivery_cols.items():
-            if orig_col in d_row and pd.notnull(d_row.get(orig_col)):
-                if new_col.lower().find('data') != -1 and isinstance(d_row[orig_col], (pd.Timestamp, datetime)):
-                    row_dict[new_col] = d_row[orig_col].strftime('%d/%m/%Y')
-                else:
-                    row_dict[new_col] = d_row[orig_col]
-            else:
-                row_dict[new_col] = ''
-        # Preenche as colunas vindas do sistema
-        for new_col, orig_col in order_system_cols.items():
-            if orig_col in s_row and pd.notnull(s_row.get(orig_col)):
-                if new_col.lower().find('data') != -1 and isinstance(s_row[orig_col], (pd.Timestamp, datetime)):
-                    row_dict[new_col] = s_row[orig_col].strftime('%d/%m/%Y')
-                else:
-                    row_dict[new_col] = s_row[orig_col]
-            else:
-                row_dict[new_col] = ''
-        row_dict['Discrepância Inicial'] = status
-        consolidated_list.append(row_dict)
-    
-    final_df = pd.DataFrame(consolidated_list)
+    system_pos = np.full(len(delivery_df), -1, dtype=np.int64)
+    status = np.full(len(delivery_df), 'Diferença', dtype=object)
+    rule = np.full(len(delivery_df), None, dtype=object)
+    matched = np.zeros(len(system_df), dtype=bool)
+
+    # Primeira passada opcional, pelo identificador (pedido x NSU)
+    if id_col_delivery is not None and id_col_system is not None:
+        id_d, id_s = _id_pairs(delivery_df, system_df, id_col_delivery, id_col_system)
+        diff, accepted = _pair_differences(delivery_df, system_df, date_col_delivery, value_col_delivery,
+                                           date_col_system, value_col_system, id_d, id_s,
+                                           value_tolerance, date_tolerance_days)
+        id_d, id_s, diff = id_d[accepted], id_s[accepted], diff[accepted]
+        system_pos[id_d] = id_s
+        status[id_d] = np.where(diff == 0, 'Correspondente', 'Correspondente (tolerância)')
+        rule[id_d] = 'Pedido/NSU'
+        matched[id_s] = True
+
+    # Realiza a correspondência dos registros por data e valor
+    pairs = _match_keys(delivery_df, date_col_delivery, value_col_delivery, np.flatnonzero(system_pos < 0)).merge(
+        _match_keys(system_df, date_col_system, value_col_system, np.flatnonzero(~matched)),
+        on=['_data', '_valor', '_ordem'], how='inner', suffixes=('_d', '_s'))
+    system_pos[pairs['_pos_d'].to_numpy()] = pairs['_pos_s'].to_numpy()
+    status[pairs['_pos_d'].to_numpy()] = 'Correspondente'
+    rule[pairs['_pos_d'].to_numpy()] = 'Data e valor'
+    matched[pairs['_pos_s'].to_numpy()] = True
+
+    # Segunda passada, com tolerância de valor/data, sobre o que não casou
+    if value_tolerance > 0 or date_tolerance_days > 0:
+        tol_d, tol_s = _tolerance_pairs(delivery_df, system_df, date_col_delivery, value_col_delivery,
+                                        date_col_system, value_col_system,
+                                        np.flatnonzero(system_pos < 0), np.flatnonzero(~matched),
+                                        value_tolerance, date_tolerance_days)
+        system_pos[tol_d] = tol_s
+        status[tol_d] = 'Correspondente (tolerância)'
+        rule[tol_d] = 'Tolerância'
+        matched[tol_s] = True
+    unmatched_system = np.flatnonzero(~matched)
+
+    # Linhas do delivery (na ordem) seguidas das vendas do sistema sem correspondência
+    d_positions = np.concatenate([np.arange(len(delivery_df)), np.full(len(unmatched_system), -1)])
+    s_positions = np.concatenate([system_pos, unmatched_system])
+
+    columns = _take_output_columns(delivery_df, order_delivery_cols, d_positions)
+    columns.update(_take_output_columns(system_df, order_system_cols, s_positions))
+    columns['Discrepância Inicial'] = pd.Categorical(
+        np.concatenate([status, np.full(len(unmatched_system), 'Diferença', dtype=object)]),
+        categories=MATCH_STATUSES)
+    columns['Regra'] = pd.Categorical(np.concatenate([rule, np.full(len(unmatched_system), None, dtype=object)]),
+                                      categories=MATCH_RULES)
+    final_df = pd.DataFrame(columns).infer_objects()
     return final_df
 
-# Funções de processamento para cada delivery:
+_XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_XLSX_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
 
-def process_ifood(uploaded_file):
+def _xlsx_column_letters_index(letters):
+    """Converte as letras da coluna (ex.: 'AB') no índice da coluna, começando em 0."""
+    index = 0
+    for char in letters:
+        index = index * 26 + (ord(char.upper()) - 64)
+    return index - 1
+
+def _xlsx_active_sheet(zin):
+    """Caminho, dentro do zip, da planilha ativa e se o arquivo usa o calendário de 1904."""
+    workbook = ElementTree.fromstring(zin.read("xl/workbook.xml"))
+    view = workbook.find(f"{_XLSX_NS}bookViews/{_XLSX_NS}workbookView")
+    active = int(view.get("activeTab", 0)) if view is not None else 0
+    sheets = workbook.findall(f"{_XLSX_NS}sheets/{_XLSX_NS}sheet")
+    rel_id = sheets[min(active, len(sheets) - 1)].get(f"{_XLSX_REL_NS}id")
+    props = workbook.find(f"{_XLSX_NS}workbookPr")
+    date1904 = props is not None and props.get("date1904") in ("1", "true")
+    rels = ElementTree.fromstring(zin.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{_XLSX_PKG_REL_NS}Relationship"):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target")
+            path = target.lstrip("/") if target.startswith("/") else "xl/" + target
+            return path, date1904
+    raise KeyError("Planilha ativa não encontrada em xl/workbook.xml")
+
+def _xlsx_shared_strings(zin):
+    if "xl/sharedStrings.xml" not in zin.namelist():
+        return []
+    strings = []
+    with zin.open("xl/sharedStrings.xml") as stream:
+        for _, elem in ElementTree.iterparse(stream):
+            if elem.tag == f"{_XLSX_NS}si":
+                # Texto simples (<t>) ou rico (<r><t>); a transcrição fonética (<rPh>) é ignorada
+                strings.append("".join(t.text or "" for t in elem.iter(f"{_XLSX_NS}t")
+                                       if t not in elem.findall(f"{_XLSX_NS}rPh/{_XLSX_NS}t")))
+                elem.clear()
+    return strings
+
+def _xlsx_date_styles(zin):
     """
-    Processa a planilha do IFood.
-    Colunas esperadas: 'N° PEDIDO', 'DATA', 'VALOR DOS ITENS'
+    Índices dos estilos de célula (cellXfs) com formato de data. Só os formatos numéricos de
+    'xl/styles.xml' são lidos; fills, fontes e bordas (onde ficam os estilos quebrados) não.
     """
-    df = pd.read_excel(uploaded_file)
-    required = ['N° PEDIDO', 'DATA', 'VALOR DOS ITENS']
-    df = df[required]
-    df['DATA'] = pd.to_datetime(df['DATA'], dayfirst=True, errors='coerce').dt.date
-    df['VALOR DOS ITENS'] = pd.to_numeric(df['VALOR DOS ITENS'], errors='coerce').fillna(0)
-    df.rename(columns={'N° PEDIDO': 'N° PEDIDO IFOOD', 'DATA': 'DATA IFOOD', 'VALOR DOS ITENS': 'VALOR IFOOD'}, inplace=True)
-    return df
+    if "xl/styles.xml" not in zin.namelist():
+        return set()
+    custom_formats = {}
+    date_styles = set()
+    in_cell_xfs = False
+    position = 0
+    with zin.open("xl/styles.xml") as stream:
+        for event, elem in ElementTree.iterparse(stream, events=("start", "end")):
+            if event == "start" and elem.tag == f"{_XLSX_NS}cellXfs":
+                in_cell_xfs = True
+            elif event == "end" and elem.tag == f"{_XLSX_NS}cellXfs":
+                in_cell_xfs = False
+            elif event == "end" and elem.tag == f"{_XLSX_NS}numFmt":
+                custom_formats[int(elem.get("numFmtId"))] = elem.get("formatCode", "")
+            elif event == "end" and elem.tag == f"{_XLSX_NS}xf" and in_cell_xfs:
+                fmt_id = int(elem.get("numFmtId", 0))
+                fmt = custom_formats.get(fmt_id, BUILTIN_FORMATS.get(fmt_id, "General"))
+                if is_date_format(fmt):
+                    date_styles.add(position)
+                position += 1
+    return date_styles
 
-def process_mais_delivery(uploaded_file):
+def _xlsx_rows(stream):
     """
-    Processa a planilha do Mais Delivery.
-    Colunas esperadas: 'Data Pedido', 'Número', 'Valor (R$)'.
-    Se der erro de estilo no Openpyxl, recorre ao read_excel_nostyles.
+    Linhas (<row>) da planilha em fluxo. Cada linha é entregue no início da seguinte, quando já
+    foi lida por inteiro, e depois retirada do <sheetData>: só limpar a linha deixaria o <row>
+    vazio preso à árvore, que cresceria com o número de linhas.
     """
+    sheet_data = row = None
+    for _, elem in ElementTree.iterparse(stream, events=("start",)):
+        if elem.tag == f"{_XLSX_NS}row":
+            if row is not None:
+                yield row
+                sheet_data.remove(row)
+            row = elem
+        elif elem.tag == f"{_XLSX_NS}sheetData":
+            sheet_data = elem
+    if row is not None:
+        yield row
+
+def _xlsx_cell_value(cell, shared_strings, date_styles, epoch):
+    cell_type = cell.get("t", "n")
+    if cell_type == "inlineStr":
+        return "".join(t.text or "" for t in cell.iter(f"{_XLSX_NS}t"))
+    value = cell.findtext(f"{_XLSX_NS}v")
+    if value is None:
+        return None
+    if cell_type == "s":
+        return shared_strings[int(value)]
+    if cell_type == "b":
+        return value == "1"
+    if cell_type in ("str", "e"):
+        return value
+    if cell_type == "d":
+        return pd.Timestamp(value).to_pydatetime()
+    number = int(value) if value.lstrip("-").isdigit() else float(value)
+    if int(cell.get("s", 0)) in date_styles:
+        return from_excel(number, epoch)
+    return number
+
+def read_excel_nostyles(uploaded_file, usecols=None):
+    """
+    Lê o arquivo Excel ignorando os estilos problemáticos.
+    A planilha ativa é lida em fluxo direto do zip original (XML da worksheet via iterparse),
+    sem passar pelo openpyxl nem regravar o arquivo: de 'xl/styles.xml' só são lidos os formatos
+    numéricos, para reconhecer as células de data. Com usecols (lista de nomes do cabeçalho)
+    apenas essas colunas são guardadas. Células ausentes são preenchidas com None.
+    """
+    if not hasattr(uploaded_file, 'read'):
+        uploaded_file = BytesIO(uploaded_file)
+    else:
+        uploaded_file.seek(0)
     try:
-        df = pd.read_excel(uploaded_file)
+        with zipfile.ZipFile(uploaded_file, "r") as zin:
+            sheet_path, date1904 = _xlsx_active_sheet(zin)
+            shared_strings = _xlsx_shared_strings(zin)
+            date_styles = _xlsx_date_styles(zin)
+            epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+            header = None
+            keep = None
+            columns = None
+            # Letras da coluna -> índice, resolvidas uma vez por coluna e não a cada célula
+            column_index = {}
+            with zin.open(sheet_path) as stream:
+                for row in _xlsx_rows(stream):
+                    values = {}
+                    next_index = 0
+                    for cell in row.iter(f"{_XLSX_NS}c"):
+                        ref = cell.get("r")
+                        if ref:
+                            letters = ref.rstrip("0123456789")
+                            index = column_index.get(letters)
+                            if index is None:
+                                index = column_index[letters] = _xlsx_column_letters_index(letters)
+                        else:
+                            index = next_index
+                        next_index = index + 1
+                        if keep is None or index in keep:
+                            values[index] = _xlsx_cell_value(cell, shared_strings, date_styles, epoch)
+                    if header is None:
+                        width = max(values) + 1 if values else 0
+                        header = [values.get(i) for i in range(width)]
+                        keep = {i: name for i, name in enumerate(header)
+                                if usecols is None or name in usecols}
+                        columns = {i: [] for i in keep}
+                        continue
+                    for i, column in columns.items():
+                        column.append(values.get(i))
+    except Exception as e:
+        raise ConsolidationError("Erro ao ler planilha sem estilos: " + str(e)) from e
+    if header is None:
+        return pd.DataFrame()
+    return pd.DataFrame({keep[i]: column for i, column in columns.items()})
+
+# Leitores das planilhas de delivery (recebem o arquivo e as colunas desejadas)
+
+def read_excel_columns(uploaded_file, usecols):
+    return pd.read_excel(uploaded_file, usecols=usecols)
+
+def read_excel_styles_fallback(uploaded_file, usecols):
+    """
+    Lê com o pandas/openpyxl; se der erro de estilo no Openpyxl, recorre ao read_excel_nostyles.
+    """
+    try:
+        return pd.read_excel(uploaded_file, usecols=usecols)
     except TypeError as e:
-        msg = str(e)
-        if "expected <class 'openpyxl.styles.fills.Fill'>" in msg:
+        if "expected <class 'openpyxl.styles.fills.Fill'>" in str(e):
             # fallback para leitura sem estilos
-            df = read_excel_nostyles(uploaded_file)
-        else:
-            # se for outro TypeError, relança
-            raise
+            return read_excel_nostyles(uploaded_file, usecols=usecols)
+        # se for outro TypeError, relança
+        raise
+
+def read_excel_legacy_xls(uploaded_file, usecols):
+    """Lê com o pandas, avisando quando o .xls está corrompido ou num formato antigo."""
+    try:
+        return pd.read_excel(uploaded_file, usecols=usecols)
+    except CompDocError as e:
+        raise ConsolidationError(
+            "Não foi possível ler o arquivo (.xls). "
+            "Ele parece corrompido ou num formato antigo. "
+            "Abra no Excel e salve como .xlsx, depois tente novamente."
+        ) from e
+
+_MONEY_NOISE = re.compile(r'R\$|\s+')
+
+def parse_money(series):
+    """
+    Converte uma coluna de valores em R$ em centavos (int64), numa única passada vetorizada:
+    remove 'R$' e espaços, troca a vírgula decimal por ponto e o que não for número vira 0.
+    """
+    if pd.api.types.is_numeric_dtype(series):
+        return to_cents(series)
+    text = series.astype(str).str.replace(_MONEY_NOISE, '', regex=True).str.replace(',', '.', regex=False)
+    return to_cents(text)
+
+# Esquemas das planilhas de delivery. Cada esquema declara:
+#   reader:      função de leitura (arquivo, colunas) -> DataFrame
+#   columns:     colunas lidas da planilha -> nome padronizado no resultado (na ordem de saída)
+#   date_col:    coluna (original) com a data do pedido
+#   money_cols:  colunas (originais) com valores em R$, convertidos para centavos (int64)
+#   value_col:   nome da coluna de valor usada na consolidação
+#   value_sum:   opcional, colunas (originais) somadas para formar value_col
+#   order_col:   nome da coluna com o número do pedido
+#   category_cols: opcional, colunas (originais) de texto repetitivo, guardadas como category
+# Um novo delivery passa a ser suportado com um novo esquema em DELIVERY_SCHEMAS.
 
-    # agora garante que temos as colunas necessárias
-    required = ['Data Pedido', 'Número', 'Valor (R$)']
-    df = df[required]
+IFOOD_SCHEMA = {
+    "reader": read_excel_columns,
+    "columns": {'N° PEDIDO': 'N° PEDIDO IFOOD', 'DATA': 'DATA IFOOD', 'VALOR DOS ITENS': 'VALOR IFOOD'},
+    "date_col": 'DATA',
+    "money_cols": ['VALOR DOS ITENS'],
+    "value_col": 'VALOR IFOOD',
+    "order_col": 'N° PEDIDO IFOOD',
+}
 
-    # tratamento de data
-    df['Data Pedido'] = pd.to_datetime(df['Data Pedido'], dayfirst=True, errors='coerce').dt.date
+MAIS_DELIVERY_SCHEMA = {
+    "reader": read_excel_styles_fallback,
+    "columns": {'Data Pedido': 'DATA MAIS DELIVERY', 'Número': 'N° PEDIDO MAIS DELIVERY',
+                'Valor (R$)': 'VALOR MAIS DELIVERY'},
+    "date_col": 'Data Pedido',
+    "money_cols": ['Valor (R$)'],
+    "value_col": 'VALOR MAIS DELIVERY',
+    "order_col": 'N° PEDIDO MAIS DELIVERY',
+}
 
-    # limpeza e conversão do valor
-    df['Valor (R$)'] = df['Valor (R$)'] \
-        .replace({r'R\$': '', r',': '.', r'\s+': ''}, regex=True) \
-        .pipe(pd.to_numeric, errors='coerce') \
-        .fillna(0)
+AIQUEFOME_SCHEMA = {
+    "reader": read_excel_legacy_xls,
+    "columns": {'Nro. Pedido': 'N° PEDIDO AI QUE FOME', 'Data': 'DATA AI QUE FOME',
+                'Total (R$)': 'Total (R$)', 'Desconto (R$)': 'Desconto (R$)'},
+    "date_col": 'Data',
+    "money_cols": ['Total (R$)', 'Desconto (R$)'],
+    "value_col": 'Valor AI QUE FOME',
+    "value_sum": ['Total (R$)', 'Desconto (R$)'],
+    "order_col": 'N° PEDIDO AI QUE FOME',
+}
 
-    # padroniza nomes para a consolidação
-    df.rename(columns={
-        'Data Pedido': 'DATA MAIS DELIVERY',
-        'Número': 'N° PEDIDO MAIS DELIVERY',
-        'Valor (R$)': 'VALOR MAIS DELIVERY'
-    }, inplace=True)
+GOOMER_SCHEMA = {
+    "reader": read_excel_columns,
+    "columns": {'ID do pedido': 'N° PEDIDO GOOMER', 'Data': 'DATA GOOMER', 'Cupom': 'CUPOM',
+                'Cupom (R$)': 'CUPOM (R$)', 'Total (R$)': 'VALOR GOOMER', 'Tipo': 'TIPO',
+                'Forma de pagamento': 'FORMA DE PAGAMENTO'},
+    "date_col": 'Data',
+    "money_cols": ['Total (R$)'],
+    "value_col": 'VALOR GOOMER',
+    "order_col": 'N° PEDIDO GOOMER',
+    "category_cols": ['Cupom', 'Tipo', 'Forma de pagamento'],
+}
 
+# Mais Delivery Guaraí: usa "Total com entrega (R$)" em vez de "Valor (R$)"
+EDVANIA_SCHEMA = {
+    "reader": read_excel_nostyles,
+    "columns": {'Data Pedido': 'DATA MAIS DELIVERY', 'Número': 'N° PEDIDO MAIS DELIVERY',
+                'Total com entrega (R$)': 'VALOR MAIS DELIVERY'},
+    "date_col": 'Data Pedido',
+    "money_cols": ['Total com entrega (R$)'],
+    "value_col": 'VALOR MAIS DELIVERY',
+    "order_col": 'N° PEDIDO MAIS DELIVERY',
+}
+
+# Esquema de cada delivery, pelo ID_Cliente do delivery no sistema
+DELIVERY_SCHEMAS = {
+    1032: IFOOD_SCHEMA,
+    1035: MAIS_DELIVERY_SCHEMA,
+    1231: AIQUEFOME_SCHEMA,
+    709:  GOOMER_SCHEMA,
+    202:  IFOOD_SCHEMA,
+    1205: EDVANIA_SCHEMA,
+}
+
+def process_delivery(uploaded_file, schema):
+    """
+    Processa a planilha de qualquer delivery conforme o seu esquema: lê só as colunas
+    declaradas, converte a data (datetime64, por dia) e os valores (centavos), calcula a coluna
+    de valor e padroniza os nomes.
+    """
+    source_cols = list(schema["columns"])
+    df = schema["reader"](uploaded_file, source_cols)
+    df = df[source_cols]
+    df[schema["date_col"]] = to_day(df[schema["date_col"]], dayfirst=True)
+    for col in schema["money_cols"]:
+        df[col] = parse_money(df[col])
+    if "value_sum" in schema:
+        df[schema["value_col"]] = df[schema["value_sum"]].sum(axis=1)
+    _categorize(df, schema.get("category_cols", []))
+    df.rename(columns=schema["columns"], inplace=True)
     return df
 
+def delivery_money_columns(schema):
+    """Colunas, já com os nomes padronizados, que process_delivery devolve em centavos."""
+    columns = [schema["columns"].get(col, col) for col in schema["money_cols"]]
+    return columns + [schema["value_col"]] if schema["value_col"] not in columns else columns
+
+def money_in_reais(df, columns):
+    """Cópia de df com as colunas em centavos convertidas para R$, para exibição."""
+    df = df.copy()
+    for col in columns:
+        if col in df.columns:
+            df[col] = df[col] / 100
+    return df
+
+def id_match_columns(id_delivery, enabled=True):
+    """
+    Argumentos id_col_delivery/id_col_system de consolidate_data para parear o número do pedido
+    do delivery com o NSU (Documento_Cartao) do sistema; vazio se enabled for falso.
+    """
+    if not enabled:
+        return {}
+    return {'id_col_delivery': DELIVERY_SCHEMAS[id_delivery]["order_col"], 'id_col_system': 'NSU'}
+
+def delivery_output_columns(schema):
+    """Colunas do delivery no resultado da consolidação (pedido, data e valor)."""
+    return {
+        'Pedido Delivery': schema["order_col"],
+        'Data Delivery': schema["columns"][schema["date_col"]],
+        'Valor Delivery': schema["value_col"],
+    }
+
+def process_ifood(uploaded_file):
+    """
+    Processa a planilha do IFood.
+    Colunas esperadas: 'N° PEDIDO', 'DATA', 'VALOR DOS ITENS'
+    """
+    return process_delivery(uploaded_file, IFOOD_SCHEMA)
+
+def process_mais_delivery(uploaded_file):
+    """
+    Processa a planilha do Mais Delivery.
+    Colunas esperadas: 'Data Pedido', 'Número', 'Valor (R$)'.
+    """
+    return process_delivery(uploaded_file, MAIS_DELIVERY_SCHEMA)
+
 def process_aiquefome(uploaded_file):
     """
     Processa a planilha do AI QUE FOME.
     Colunas esperadas: 'Nro. Pedido', 'Data', 'Total (R$)', 'Desconto (R$)'
     """
-    try:
-        df = pd.read_excel(uploaded_file)
-    except CompDocError:
-        st.error(
-            "Não foi possível ler o arquivo AI QUE FOME (.xls). "
-            "Ele parece corrompido ou num formato antigo. "
-            "Abra no Excel e salve como .xlsx, depois tente novamente."
-        )
-        st.stop()
-    # --- continua o tratamento normal ---
-    required = ['Nro. Pedido', 'Data', 'Total (R$)', 'Desconto (R$)']
-    df = df[required]
-    df['Data'] = pd.to_datetime(df['Data'], dayfirst=True, errors='coerce').dt.date
-    for col in ['Total (R$)', 'Desconto (R$)']:
-        df[col] = df[col].replace({r'R\$': '', ',': '.', r'\s+': ''}, regex=True)
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-    df['Valor AI QUE FOME'] = df['Total (R$)'] + df['Desconto (R$)']
-    df.rename(columns={'Nro. Pedido': 'N° PEDIDO AI QUE FOME', 'Data': 'DATA AI QUE FOME'}, inplace=True)
-    return df
-
+    return process_delivery(uploaded_file, AIQUEFOME_SCHEMA)
 
 def process_goomer(uploaded_file):
     """
     Processa a planilha do GOOMER.
     Colunas esperadas: ['ID do pedido','Data', 'Cupom','Cupom (R$)', 'Total (R$)', 'Tipo', 'Forma de pagamento']
     """
-    df = pd.read_excel(uploaded_file)
-    required = ['ID do pedido','Data', 'Cupom','Cupom (R$)', 'Total (R$)', 'Tipo', 'Forma de pagamento']
-    df = df[required]
-    df['Data'] = pd.to_datetime(df['Data'], dayfirst=True, errors='coerce').dt.date
-    df['Total (R$)'] = df['Total (R$)'].replace({r'R\$': '', ',': '.', r'\s+': ''}, regex=True)
-    df['Total (R$)'] = pd.to_numeric(df['Total (R$)'], errors='coerce').fillna(0)
-    df.rename(columns={
-        'ID do pedido': 'N° PEDIDO GOOMER',
-        'Data': 'DATA GOOMER',
-        'Cupom': 'CUPOM',
-        'Cupom (R$)': 'CUPOM (R$)',
-        'Total (R$)': 'VALOR GOOMER',
-        'Tipo': 'TIPO',
-        'Forma de pagamento': 'FORMA DE PAGAMENTO'
-    }, inplace=True)
-    return df
+    return process_delivery(uploaded_file, GOOMER_SCHEMA)
 
-def read_excel_nostyles(uploaded_file):
+def process_edvania(uploaded_file):
     """
-    Lê o arquivo Excel ignorando os estilos problemáticos.
-    Essa função lê o arquivo como um zip, substitui o conteúdo de 'xl/styles.xml'
-    por um nó mínimo de fills e reconstroi o arquivo, garantindo que todas as linhas
-    tenham o mesmo número de colunas, preenchendo com None as células ausentes.
+    Processa a planilha do EDVANIA SOBRINHO DA SILVA (Mais Delivery Guaraí).
+    Colunas esperadas: 'Data Pedido', 'Número', 'Total com entrega (R$)'
     """
-    # Garantir que temos um objeto BytesIO
+    return process_delivery(uploaded_file, EDVANIA_SCHEMA)
+
+class ParsedDeliveryCache:
+    """
+    Cache LRU das planilhas de delivery já processadas, com chave (hash do conteúdo do arquivo,
+    delivery). Guarda no máximo max_entries planilhas e max_bytes de memória (medida com
+    memory_usage(deep=True)); ao passar dos limites, as menos usadas são descartadas.
+    """
+    def __init__(self, max_entries=16, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, df):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df, size)
+            self._total_bytes += size
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+@lru_cache(maxsize=None)
+def get_parsed_delivery_cache():
+    config = get_settings().get("cache", {})
+    return ParsedDeliveryCache(max_entries=int(config.get("parsed_max_entries", 16)),
+                               max_bytes=int(config.get("parsed_max_mb", 512)) * 1024 * 1024)
+
+def file_digest(uploaded_file):
+    """Hash SHA-256 do conteúdo do arquivo, lido em blocos; a posição volta para o início."""
     if not hasattr(uploaded_file, 'read'):
-         uploaded_file = BytesIO(uploaded_file)
+        return hashlib.sha256(uploaded_file).hexdigest()
+    uploaded_file.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: uploaded_file.read(1024 * 1024), b""):
+        digest.update(block)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+def parse_delivery_cached(uploaded_file, delivery_key, processor, cache=None):
+    """
+    Processa a planilha com processor (process_ifood, process_goomer, ...) reaproveitando o
+    resultado de uma execução anterior com o mesmo arquivo e o mesmo delivery.
+    Devolve sempre uma cópia, para que o DataFrame guardado não seja alterado.
+    """
+    if cache is None:
+        cache = get_parsed_delivery_cache()
+    key = (file_digest(uploaded_file), delivery_key)
+    df = cache.get(key)
+    if df is None:
+        df = processor(uploaded_file)
+        cache.put(key, df)
+    return df.copy()
+
+# Histórico de conciliação: pares pedido do delivery <-> ID_Venda já confirmados
+
+class ReconciliationLedger:
+    """
+    Histórico persistente (SQLite) dos pares já conciliados, por loja e delivery:
+    número do pedido no delivery <-> ID_Venda do sistema. Cada pedido e cada venda aparecem
+    no máximo uma vez por par loja x delivery. Uma conexão é aberta a cada operação, de modo
+    que o mesmo arquivo pode ser usado por várias threads e processos.
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conciliacao (
+                    id_empresa INTEGER NOT NULL,
+                    id_delivery INTEGER NOT NULL,
+                    pedido TEXT NOT NULL,
+                    id_venda TEXT NOT NULL,
+                    data TEXT,
+                    valor REAL,
+                    regra TEXT NOT NULL,
+                    gravado_em TEXT NOT NULL,
+                    PRIMARY KEY (id_empresa, id_delivery, pedido),
+                    UNIQUE (id_empresa, id_delivery, id_venda)
+                )""")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def confirmed(self, id_empresa, id_delivery):
+        """Pares já confirmados da loja/delivery, com as colunas 'pedido' e 'id_venda'."""
+        with self._connect() as conn:
+            return pd.read_sql("SELECT pedido, id_venda FROM conciliacao WHERE id_empresa = ? AND id_delivery = ?",
+                               conn, params=[int(id_empresa), int(id_delivery)])
+
+    def record(self, id_empresa, id_delivery, pairs):
+        """
+        Grava os pares (DataFrame com 'pedido', 'id_venda', 'data', 'valor' e 'regra').
+        Pares cujo pedido ou venda já estejam no histórico são ignorados. Retorna quantos foram gravados.
+        """
+        if pairs.empty:
+            return 0
+        recorded_at = datetime.now().isoformat(timespec="seconds")
+        rows = [(int(id_empresa), int(id_delivery), pedido, id_venda,
+                 None if pd.isnull(day) else str(day), None if pd.isnull(valor) else float(valor), regra, recorded_at)
+                for pedido, id_venda, day, valor, regra
+                in pairs[['pedido', 'id_venda', 'data', 'valor', 'regra']].itertuples(index=False)]
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO conciliacao VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+
+    def discard(self, id_empresa, id_delivery, pedidos):
+        """Remove os pares dos pedidos informados, que deixaram de valer. Retorna quantos foram removidos."""
+        rows = [(int(id_empresa), int(id_delivery), pedido) for pedido in pedidos]
+        if not rows:
+            return 0
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM conciliacao WHERE id_empresa = ? AND id_delivery = ? AND pedido = ?", rows)
+            return conn.total_changes - before
+
+    def forget(self, id_empresa, id_delivery, start_date=None, end_date=None):
+        """Remove os pares da loja/delivery (opcionalmente só os do período), para refazer a conciliação."""
+        query = "DELETE FROM conciliacao WHERE id_empresa = ? AND id_delivery = ?"
+        params = [int(id_empresa), int(id_delivery)]
+        if start_date is not None:
+            query += " AND data >= ?"
+            params.append(start_date.isoformat())
+        if end_date is not None:
+            query += " AND data <= ?"
+            params.append(end_date.isoformat())
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount
+
+@lru_cache(maxsize=None)
+def get_reconciliation_ledger():
+    # Opcional: só existe se [conciliacao] path estiver configurado
+    path = get_settings().get("conciliacao", {}).get("path")
+    return ReconciliationLedger(path) if path else None
+
+def consolidate_with_ledger(delivery_df, system_df, id_empresa, id_delivery, ledger,
+                            value_tolerance=0.0, date_tolerance_days=0, match_ids=False, in_cents=True):
+    """
+    Consolida como consolidate_data, reaproveitando os pares de ledger ('Regra' = 'Histórico')
+    que ainda estão dentro das tolerâncias. Só os novos pares exatos sem ambiguidade são gravados;
+    números de pedido ou venda repetidos na execução não são reaproveitados nem gravados.
+    """
+    order_delivery_cols = delivery_output_columns(DELIVERY_SCHEMAS[id_delivery])
+    date_col_delivery = order_delivery_cols['Data Delivery']
+    value_col_delivery = order_delivery_cols['Valor Delivery']
+    delivery_df = delivery_df.copy()
+    system_df = system_df.copy()
+    delivery_df[date_col_delivery] = to_day(delivery_df[date_col_delivery], dayfirst=True)
+    system_df['Data_Faturamento'] = to_day(system_df['Data_Faturamento'])
+    delivery_df[value_col_delivery] = _as_cents(delivery_df[value_col_delivery], in_cents)
+    system_df['Valor Bruto'] = _as_cents(system_df['Valor Bruto'], in_cents)
+
+    # Um número repetido (ex.: venda dividida em várias linhas do ContasAReceber) não identifica a linha
+    delivery_keys = normalize_ids(delivery_df[order_delivery_cols['Pedido Delivery']])
+    system_keys = normalize_ids(system_df['ID_Venda'])
+    unique_delivery = (delivery_keys.notna() & ~delivery_keys.duplicated(keep=False)).to_numpy()
+    unique_system = (system_keys.notna() & ~system_keys.duplicated(keep=False)).to_numpy()
+
+    # Pares do histórico com os dois lados presentes, conferidos com a data e o valor atuais
+    known = ledger.confirmed(id_empresa, id_delivery)
+    known = known.merge(pd.DataFrame({'pedido': delivery_keys, '_pos_d': np.arange(len(delivery_df))})[unique_delivery],
+                        on='pedido')
+    known = known.merge(pd.DataFrame({'id_venda': system_keys, '_pos_s': np.arange(len(system_df))})[unique_system],
+                        on='id_venda')
+    diff, accepted = _pair_differences(delivery_df, system_df, date_col_delivery, value_col_delivery,
+                                       'Data_Faturamento', 'Valor Bruto', known['_pos_d'].to_numpy(),
+                                       known['_pos_s'].to_numpy(), value_tolerance, date_tolerance_days)
+    ledger.discard(id_empresa, id_delivery, known.loc[~accepted, 'pedido'])
+    known, diff = known[accepted], diff[accepted]
+    new_delivery = np.ones(len(delivery_df), dtype=bool)
+    new_delivery[known['_pos_d'].to_numpy()] = False
+    new_system = np.ones(len(system_df), dtype=bool)
+    new_system[known['_pos_s'].to_numpy()] = False
+
+    fresh = consolidate_data(delivery_df[new_delivery], system_df[new_system],
+                             date_col_delivery, value_col_delivery, 'Data_Faturamento', 'Valor Bruto',
+                             order_delivery_cols, SYSTEM_OUTPUT_COLUMNS,
+                             value_tolerance=value_tolerance, date_tolerance_days=date_tolerance_days,
+                             **id_match_columns(id_delivery, match_ids))
+
+    # Grava os novos pares exatos sem ambiguidade
+    delivery_counts = delivery_df[new_delivery].groupby([date_col_delivery, value_col_delivery]).size()
+    system_counts = system_df[new_system].groupby(['Data_Faturamento', 'Valor Bruto']).size()
+    single_keys = delivery_counts[delivery_counts == 1].index.intersection(system_counts[system_counts == 1].index)
+    exact = fresh[fresh['Discrepância Inicial'] == 'Correspondente']
+    exact_keys = pd.MultiIndex.from_arrays([exact['Data Delivery'], to_cents(exact['Valor Delivery']).to_numpy()])
+    exact = exact[(exact['Regra'] == 'Pedido/NSU').to_numpy() | exact_keys.isin(single_keys)]
+    new_pairs = pd.DataFrame({'pedido': normalize_ids(exact['Pedido Delivery']),
+                              'id_venda': normalize_ids(exact['ID Venda Sistema']),
+                              'data': exact['Data Delivery'].dt.strftime('%Y-%m-%d'),
+                              'valor': exact['Valor Delivery'],
+                              'regra': exact['Regra']})
+    new_pairs = new_pairs[new_pairs['pedido'].isin(delivery_keys[unique_delivery])
+                          & new_pairs['id_venda'].isin(system_keys[unique_system])]
+    ledger.record(id_empresa, id_delivery, new_pairs)
+    if known.empty:
+        return fresh
+
+    columns = _take_output_columns(delivery_df, order_delivery_cols, known['_pos_d'].to_numpy())
+    columns.update(_take_output_columns(system_df, SYSTEM_OUTPUT_COLUMNS, known['_pos_s'].to_numpy()))
+    columns['Discrepância Inicial'] = pd.Categorical(np.where(diff == 0, 'Correspondente',
+                                                              'Correspondente (tolerância)'),
+                                                     categories=MATCH_STATUSES)
+    columns['Regra'] = pd.Categorical(np.full(len(known), 'Histórico', dtype=object), categories=MATCH_RULES)
+    reused = pd.DataFrame(columns)
+    return _sort_consolidated(pd.concat([reused, fresh], ignore_index=True))
+
+# Conciliação em duas fases: totais por dia primeiro, detalhe só dos dias com diferença
+
+def delivery_daily_totals(delivery_df, date_col, value_col, in_cents=True):
+    """
+    Totais por dia da planilha do delivery, no mesmo formato de run_system_daily_totals
+    ('quantidade', 'centavos' e 'quadrados', indexados pelo dia). Linhas sem data ficam de fora.
+    """
+    frame = pd.DataFrame({'dia': to_day(delivery_df[date_col], dayfirst=True),
+                          'centavos': _as_cents(delivery_df[value_col], in_cents)})
+    return _frame_daily_totals(frame, 'dia', 'centavos')
+
+def mismatched_days(delivery_totals, system_totals):
+    """
+    Dias em que a quantidade, a soma ou a soma dos quadrados dos valores do delivery e do
+    sistema diferem (inclusive os dias com vendas só de um dos lados). A soma dos quadrados
+    evita tomar como conferido um dia com a mesma quantidade e soma mas valores trocados.
+    """
+    both = delivery_totals.join(system_totals, how='outer', lsuffix='_d', rsuffix='_s').fillna(0)
+    same = ((both['quantidade_d'] == both['quantidade_s']) & (both['centavos_d'] == both['centavos_s'])
+            & np.isclose(both['quadrados_d'], both['quadrados_s'], rtol=1e-9, atol=1e-6))
+    return both.index[~same]
+
+def _sort_consolidated(final_df):
+    """Mesma ordem de consolidate_data: linhas do delivery por data e valor, depois as vendas sem par."""
+    only_system = final_df['Data Delivery'].isna() & final_df['Valor Delivery'].isna()
+    sort_keys = pd.DataFrame({
+        '_sistema': only_system,
+        '_data': final_df['Data Delivery'].where(~only_system),
+        '_valor': final_df['Valor Delivery'].where(~only_system),
+    })
+    order = sort_keys.sort_values(['_sistema', '_data', '_valor'], kind='stable').index
+    return final_df.loc[order].reset_index(drop=True).infer_objects()
+
+def consolidate_two_phase(delivery_df, start_date, end_date, id_empresa, id_delivery, client_ids, id_forma_list,
+                          value_tolerance=0.0, date_tolerance_days=0, match_ids=False, system_totals=None,
+                          pool=None, cache=None, cancel_event=None, refresh=False, in_cents=True):
+    """
+    Consolidação em duas fases: os dias cujos totais batem com os do sistema por dia de
+    faturamento (run_system_daily_totals ou system_totals) saem como 'Correspondente' com 'Regra'
+    = 'Totais do dia', sem ler as vendas; só os dias com diferença passam por consolidate_data.
+    """
+    order_delivery_cols = delivery_output_columns(DELIVERY_SCHEMAS[id_delivery])
+    date_col_delivery = order_delivery_cols['Data Delivery']
+    value_col_delivery = order_delivery_cols['Valor Delivery']
+    delivery_df = delivery_df.copy()
+    delivery_df[date_col_delivery] = to_day(delivery_df[date_col_delivery], dayfirst=True)
+    delivery_df[value_col_delivery] = _as_cents(delivery_df[value_col_delivery], in_cents)
+    if system_totals is None:
+        system_totals = run_system_daily_totals(start_date, end_date, id_empresa, client_ids, id_forma_list,
+                                                pool=pool)
+
+    differing = mismatched_days(delivery_daily_totals(delivery_df, date_col_delivery, value_col_delivery),
+                                daily_totals_by(system_totals, 'faturamento'))
+    delivery_days = delivery_df[date_col_delivery]
+    clean = (delivery_days.notna() & ~delivery_days.isin(differing)).to_numpy()
+
+    # Dias de emissão com vendas faturadas nos dias com diferença (ou sem data de faturamento)
+    needed = system_totals['faturamento'].isin(differing) | system_totals['faturamento'].isna()
+    emission_days = sorted(set(system_totals.loc[needed, 'emissao'].dt.date))
+    frames = []
+    for first, last in _contiguous_ranges(emission_days):
+        fetched = run_system_query(first, last, id_empresa, client_ids, id_forma_list, pool=pool,
+                                   cache=cache, cancel_event=cancel_event, refresh=refresh)
+        billing = fetched['Data_Faturamento']
+        frames.append(fetched[billing.isin(differing) | billing.isna()])
+    if frames:
+        system_df = _categorize(pd.concat(frames, ignore_index=True), SYSTEM_CATEGORY_COLUMNS)
+    else:
+        system_df = pd.DataFrame({'ID_Venda': pd.Series(dtype=np.int64), 'NSU': pd.Series(dtype=object),
+                                  'Valor Bruto': pd.Series(dtype=np.int64),
+                                  'Data_Faturamento': pd.Series(dtype='datetime64[ns]')})
+    fresh = consolidate_data(delivery_df[~clean], system_df,
+                             date_col_delivery, value_col_delivery, 'Data_Faturamento', 'Valor Bruto',
+                             order_delivery_cols, SYSTEM_OUTPUT_COLUMNS,
+                             value_tolerance=value_tolerance, date_tolerance_days=date_tolerance_days,
+                             **id_match_columns(id_delivery, match_ids))
+    logger.info(json.dumps({"duas_fases": f"{id_empresa}_{id_delivery}", "dias_com_diferenca": len(differing),
+                            "dias_de_emissao_detalhados": len(emission_days), "vendas_detalhadas": len(system_df),
+                            "pedidos_conferidos_pelo_total": int(clean.sum())}, ensure_ascii=False))
+
+    positions = np.flatnonzero(clean)
+    columns = _take_output_columns(delivery_df, order_delivery_cols, positions)
+    # Sem venda lida: posição -1 em todas as colunas do sistema, que ficam nulas
+    columns.update(_take_output_columns(system_df, SYSTEM_OUTPUT_COLUMNS, np.full(len(positions), -1)))
+    columns['Discrepância Inicial'] = pd.Categorical(np.full(len(positions), 'Correspondente', dtype=object),
+                                                     categories=MATCH_STATUSES)
+    columns['Regra'] = pd.Categorical(np.full(len(positions), 'Totais do dia', dtype=object),
+                                      categories=MATCH_RULES)
+    by_totals = pd.DataFrame(columns)[list(fresh.columns)]
+    return _sort_consolidated(pd.concat([by_totals, fresh], ignore_index=True))
+
+# Consolidação em lote (várias lojas e deliverys de uma vez)
+
+def run_system_query_grouped(start_date, end_date, pairs, delivery_rules, pool=None, chunksize=50000):
+    """
+    Uma única consulta ao sistema para todos os pares (id_empresa, id_delivery) do período,
+    com a união das lojas, clientes e formas de pagamento; o resultado é separado por par
+    conforme delivery_rules. Retorna {par: DataFrame}.
+    Ao contrário de run_system_query, não usa o cache por dia (a consulta agrupada não tem a
+    chave de um par só) nem aceita cancel_event: o lote sempre lê o período inteiro do banco.
+    """
+    if pool is None:
+        pool = get_connection_pool()
+    empresa_ids = sorted({id_empresa for id_empresa, _ in pairs})
+    client_ids = sorted({c for _, d in pairs for c in delivery_rules[d]["client_ids"]})
+    forma_ids = sorted({f for _, d in pairs for f in delivery_rules[d]["id_forma"]})
+    df = _query_system_range(start_date, end_date, empresa_ids, client_ids, forma_ids, pool,
+                             chunksize=chunksize)
+    del df['Data_Emissao']
+    result = {}
+    for id_empresa, id_delivery in pairs:
+        rules = delivery_rules[id_delivery]
+        mask = ((df['ID_Empresa'] == id_empresa) & df['ID_Cliente'].isin(rules["client_ids"])
+                & df['ID_Forma'].isin(rules["id_forma"]))
+        result[(id_empresa, id_delivery)] = df[mask].reset_index(drop=True)
+    return result
+
+def _parse_delivery_bytes(data, id_delivery):
+    return process_delivery(BytesIO(data), DELIVERY_SCHEMAS[id_delivery])
+
+def _consolidate_pair(delivery_df, system_df, pair, value_tolerance, date_tolerance_days, ledger_path=None,
+                      match_ids=False):
+    id_empresa, id_delivery = pair
+    if ledger_path:
+        return consolidate_with_ledger(delivery_df, system_df, id_empresa, id_delivery,
+                                       ReconciliationLedger(ledger_path), value_tolerance, date_tolerance_days,
+                                       match_ids=match_ids)
+    order_delivery_cols = delivery_output_columns(DELIVERY_SCHEMAS[id_delivery])
+    return consolidate_data(delivery_df, system_df,
+                            order_delivery_cols['Data Delivery'], order_delivery_cols['Valor Delivery'],
+                            'Data_Faturamento', 'Valor Bruto',
+                            order_delivery_cols, SYSTEM_OUTPUT_COLUMNS,
+                            value_tolerance=value_tolerance, date_tolerance_days=date_tolerance_days,
+                            **id_match_columns(id_delivery, match_ids))
+
+def consolidate_batch(uploads, start_date, end_date, delivery_rules, tolerances=None,
+                      max_workers=None, pool=None, ledger=None, match_ids=False):
+    """
+    Consolida vários pares (id_empresa, id_delivery) de uma vez.
+    uploads é um dicionário {(id_empresa, id_delivery): bytes da planilha}; tolerances, opcional,
+    mapeia id_delivery -> {"valor": R$, "dias": n} (sem tolerância para os deliverys ausentes).
+    As planilhas são processadas em paralelo num pool de processos enquanto a consulta agrupada
+    do sistema roda (run_system_query_grouped, sem o cache por dia); depois a correspondência de
+    cada par também roda em paralelo. Com ledger (ReconciliationLedger), os pares já conciliados
+    são reaproveitados (ver consolidate_with_ledger); com match_ids, cada par passa antes pela
+    correspondência pedido x NSU. Retorna {par: DataFrame consolidado}.
+    """
+    tolerances = tolerances or {}
+    ledger_path = ledger.path if ledger is not None else None
+    pairs = list(uploads)
+    if not pairs:
+        return {}
+    workers = max_workers or min(len(pairs), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = {pair: executor.submit(_parse_delivery_bytes, uploads[pair], pair[1]) for pair in pairs}
+        system = run_system_query_grouped(start_date, end_date, pairs, delivery_rules, pool=pool)
+        matched = {}
+        for pair in pairs:
+            tolerance = tolerances.get(pair[1], {"valor": 0.0, "dias": 0})
+            matched[pair] = executor.submit(_consolidate_pair, parsed[pair].result(), system[pair],
+                                            pair, tolerance["valor"], tolerance["dias"], ledger_path,
+                                            match_ids)
+        return {pair: future.result() for pair, future in matched.items()}
+
+def batch_sheet_name(id_empresa, id_delivery, empresa_names=None, delivery_names=None):
+    """Nome da aba de um par (o Excel limita a 31 caracteres e proíbe []:*?/\\)."""
+    empresa = (empresa_names or {}).get(id_empresa, str(id_empresa))
+    delivery = (delivery_names or {}).get(id_delivery, str(id_delivery))
+    name = re.sub(r'[\[\]:*?/\\]', '', f"{empresa} - {delivery}")
+    return name[:31]
+
+def build_batch_workbook(results, empresa_names=None, delivery_names=None, target=None):
+    """
+    Gera um único .xlsx com uma aba por par (id_empresa, id_delivery), mais a aba de resumo
+    diário de todos os pares (ver write_consolidated_xlsx).
+    """
+    sheets = {}
+    summaries = []
+    for (id_empresa, id_delivery), df in results.items():
+        name = batch_sheet_name(id_empresa, id_delivery, empresa_names, delivery_names)
+        if name in sheets:
+            name = f"{id_empresa}-{id_delivery} {name}"[:31]
+        sheets[name] = df
+        summary = build_daily_summary(df)
+        summary.insert(0, 'Aba', name)
+        summaries.append(summary)
+    summary = pd.concat(summaries, ignore_index=True) if summaries else None
+    return write_consolidated_xlsx(sheets, summary=summary, target=target)
+
+def prepare_for_parquet(df):
+    """
+    Tipos anuláveis do pandas em todas as colunas, para que as colunas de texto com nulos
+    (lado sem correspondência) sejam gravadas em Parquet como texto e não como object misto.
+    """
+    return df.convert_dtypes()
+
+# Exportação do resultado
+
+EXPORT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx"),
+    "csv": ("text/csv", ".csv"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+def build_daily_summary(consolidated_df):
+    """
+    Resumo por dia do resultado da consolidação: quantidade de pedidos correspondidos
+    (exatos e por tolerância), diferenças de cada lado e totais em R$ do delivery e do sistema.
+    O dia é a data do delivery ou, nas vendas sem correspondência, a data do sistema.
+    """
+    df = consolidated_df
+    status = df['Discrepância Inicial']
+    delivery_value = pd.to_numeric(df['Valor Delivery'], errors='coerce')
+    system_value = pd.to_numeric(df['Valor Sistema'], errors='coerce')
+    # Pedidos conferidos pelos totais do dia (consolidate_two_phase) não têm a venda lida; o
+    # total do sistema nesses dias é igual ao do delivery, que já foi conferido
+    system_value = system_value.where(df['Regra'] != 'Totais do dia', delivery_value)
+    day = df['Data Delivery'].fillna(df['Data Sistema'])
+    parts = pd.DataFrame({
+        'Data': day,
+        'Correspondentes': status == 'Correspondente',
+        'Correspondentes (tolerância)': status == 'Correspondente (tolerância)',
+        'Diferenças delivery': (status == 'Diferença') & delivery_value.notna(),
+        'Diferenças sistema': (status == 'Diferença') & delivery_value.isna(),
+        'Total delivery (R$)': delivery_value.fillna(0),
+        'Total sistema (R$)': system_value.fillna(0),
+    })
+    summary = parts.groupby('Data', dropna=False).sum().reset_index()
+    summary['Diferença (R$)'] = (summary['Total delivery (R$)'] - summary['Total sistema (R$)']).round(2)
+    return summary
+
+# Linhas convertidas para objetos Python de cada vez na gravação do xlsx
+XLSX_BLOCK_ROWS = 10000
+
+def _write_sheet(workbook, name, df, header_format=None, block_rows=XLSX_BLOCK_ROWS):
+    """
+    Escreve o DataFrame linha a linha (o modo constant_memory exige a ordem das linhas). As
+    colunas são convertidas em objetos Python em blocos de block_rows linhas, para que a memória
+    usada não cresça com o tamanho do resultado.
+    """
+    worksheet = workbook.add_worksheet(name)
+    worksheet.write_row(0, 0, [str(c) for c in df.columns], header_format)
+    for start in range(0, len(df), block_rows):
+        block = df.iloc[start:start + block_rows]
+        # Colunas do bloco em listas de objetos Python; nulos viram None (célula vazia)
+        columns = []
+        for col in block.columns:
+            values = block[col]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                # date do Python ocupa bem menos que Timestamp; o formato dd/mm/aaaa vem do workbook
+                values = values.dt.date
+            values = values.astype(object)
+            columns.append(values.where(values.notna(), None).tolist())
+        for row, values in enumerate(zip(*columns), start=start + 1):
+            worksheet.write_row(row, 0, values)
+
+def write_consolidated_xlsx(sheets, summary=None, target=None):
+    """
+    Grava as abas {nome: DataFrame} (e, se informada, a aba 'Resumo') com o xlsxwriter em modo
+    constant_memory: cada linha vai direto para o arquivo, sem montar a planilha em memória.
+    target pode ser um caminho ou um arquivo binário; sem target, o .xlsx é gravado num arquivo
+    temporário, devolvido aberto e posicionado no início.
+    """
+    output = target if target is not None else tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True,
+                                            'default_date_format': 'dd/mm/yyyy'})
+    header_format = workbook.add_format({'bold': True})
+    for name, df in sheets.items():
+        _write_sheet(workbook, name, df, header_format)
+    if summary is not None:
+        _write_sheet(workbook, 'Resumo', summary, header_format)
+    workbook.close()
+    if target is None:
+        output.seek(0)
+    return output
+
+def export_consolidated(consolidated_df, fmt="xlsx", target=None):
+    """
+    Exporta o resultado da consolidação em xlsx (com a aba 'Resumo' diária), csv ou parquet.
+    Devolve target ou, sem ele, um arquivo temporário aberto e posicionado no início.
+    """
+    if fmt == "xlsx":
+        return write_consolidated_xlsx({'Consolidado': consolidated_df},
+                                       summary=build_daily_summary(consolidated_df), target=target)
+    output = target if target is not None else tempfile.TemporaryFile()
+    if fmt == "csv":
+        # Padrão brasileiro do Excel: ; como separador, vírgula decimal e datas dd/mm/aaaa
+        consolidated_df.to_csv(output, sep=';', decimal=',', index=False, date_format='%d/%m/%Y',
+                               encoding='utf-8-sig')
+    elif fmt == "parquet":
+        prepare_for_parquet(consolidated_df).to_parquet(output, index=False)
     else:
-         uploaded_file.seek(0)
-    content = uploaded_file.read()
-    uploaded_file = BytesIO(content)
+        raise ValueError(f"Formato de exportação desconhecido: {fmt}")
+    if target is None:
+        output.seek(0)
+    return output
+
+# Instrumentação das etapas (tempo, linhas, bytes e memória)
+
+def _current_rss_mb():
+    """Memória residente (RSS) atual do processo, em MB; None onde não há /proc (fora do Linux)."""
     try:
-        with zipfile.ZipFile(uploaded_file, "r") as zin:
-            filelist = zin.namelist()
-            if "xl/styles.xml" in filelist:
-                styles = zin.read("xl/styles.xml").decode("utf-8")
-                # Substituir o nó <fills> por um nó mínimo válido
-                styles = re.sub(r'<fills[^>]*>.*?</fills>', '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>', styles, flags=re.DOTALL)
-                mem_zip = BytesIO()
-                with zipfile.ZipFile(mem_zip, mode="w") as zout:
-                    for item in zin.infolist():
-                        if item.filename == "xl/styles.xml":
-                            zout.writestr(item, styles)
-                        else:
-                            zout.writestr(item, zin.read(item.filename))
-                mem_zip.seek(0)
-                wb = load_workbook(mem_zip, read_only=True, data_only=True)
-            else:
-                uploaded_file.seek(0)
-                wb = load_workbook(uploaded_file, read_only=True, data_only=True)
-    except Exception as e:
-        st.error("Erro ao ler planilha sem estilos: " + str(e))
-        raise e
-    ws = wb.active
-    data = ws.values
-    cols = list(next(data))
-    expected_cols = len(cols)
-    data_rows = []
-    for row in data:
-        row = list(row)
-        if len(row) < expected_cols:
-            row.extend([None]*(expected_cols - len(row)))
-        data_rows.append(row)
-    return pd.DataFrame(data_rows, columns=cols)
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
 
-def process_edvania(uploaded_file):
+class _RssSampler:
     """
-    Processa a planilha do EDVANIA SOBRINHO DA SILVA (Mais Delivery Guaraí).
-    Utiliza a coluna "Total com entrega (R$)" em vez de "Valor (R$)".
-    """
-    df = read_excel_nostyles(uploaded_file)
-    required = ['Data Pedido', 'Número', 'Total com entrega (R$)']
-    df = df[required]
-    df['Data Pedido'] = pd.to_datetime(df['Data Pedido'], dayfirst=True, errors='coerce').dt.date
-    df['Total com entrega (R$)'] = df['Total com entrega (R$)'].replace({r'R\$': '', ',': '.', r'\s+': ''}, regex=True)
-    df['Total com entrega (R$)'] = pd.to_numeric(df['Total com entrega (R$)'], errors='coerce').fillna(0)
-    df.rename(columns={'Data Pedido': 'DATA MAIS DELIVERY', 'Número': 'N° PEDIDO MAIS DELIVERY', 
-                         'Total com entrega (R$)': 'VALOR MAIS DELIVERY'}, inplace=True)
-    return df
+    Lê o RSS do processo a cada interval segundos numa thread enquanto a etapa roda e guarda o
+    maior valor, para medir o pico da etapa sem o custo do tracemalloc.
+    """
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.start_mb = self.peak_mb = _current_rss_mb()
+        self._done = threading.Event()
+        self._thread = None
+        if self.start_mb is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, _current_rss_mb())
+
+    def stop(self):
+        """Encerra a amostragem e devolve o pico acima do RSS do início da etapa, em MB."""
+        if self._thread is None:
+            return None
+        self._done.set()
+        self._thread.join()
+        self.peak_mb = max(self.peak_mb, _current_rss_mb())
+        return round(self.peak_mb - self.start_mb, 1)
+
+# Só uma etapa por vez roda sob o cProfile e o tracemalloc: o Python 3.12+ não aceita dois
+# cProfile ativos ao mesmo tempo, e o pico do tracemalloc é global
+_profiling_lock = threading.Lock()
+
+class RunMetrics:
+    """
+    Métricas por etapa de uma consolidação: tempo de parede, linhas, bytes lidos/gravados e
+    pico de memória da etapa (o maior RSS do processo durante a etapa, menos o RSS do início,
+    amostrado numa thread). Cada etapa é medida com `with metrics.stage("nome") as info:`
+    (info["linhas"] e info["bytes"] podem ser preenchidos dentro do bloco) e, ao terminar, é
+    emitida como uma linha de log em JSON.
+    Com profile_dir, cada etapa também roda sob o cProfile e o tracemalloc: o perfil (.prof) e
+    as maiores alocações (.txt) são gravados em profile_dir e o pico do tracemalloc entra nas
+    métricas. Etapas podem rodar em threads diferentes ao mesmo tempo; nesse caso só a primeira
+    gera o perfil, e os picos incluem as alocações das etapas simultâneas.
+    """
+    def __init__(self, run_name="consolidacao", profile_dir=None):
+        self.run_id = f"{run_name}_{datetime.now():%Y%m%d_%H%M%S}"
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.profile_files = []
+
+    @contextmanager
+    def stage(self, name, **info):
+        record = {"execucao": self.run_id, "etapa": name}
+        profiling = bool(self.profile_dir) and _profiling_lock.acquire(blocking=False)
+        if self.profile_dir and not profiling:
+            record["perfil"] = "não gerado: outra etapa simultânea está em perfil"
+        profiler = None
+        sampler = _RssSampler()
+        start = time.perf_counter()
+        try:
+            if profiling:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                tracemalloc.start()
+                tracemalloc.reset_peak()
+                profiler = cProfile.Profile()
+                profiler.enable()
+            yield info
+        except BaseException as e:
+            record["erro"] = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            if profiling:
+                try:
+                    if tracemalloc.is_tracing():
+                        _, peak = tracemalloc.get_traced_memory()
+                        snapshot = tracemalloc.take_snapshot()
+                        tracemalloc.stop()
+                        record["pico_tracemalloc_mb"] = round(peak / 2 ** 20, 1)
+                        base = os.path.join(self.profile_dir, f"{self.run_id}_{name}")
+                        with open(base + "_memoria.txt", "w", encoding="utf-8") as f:
+                            for stat in snapshot.statistics("lineno")[:30]:
+                                f.write(f"{stat}\n")
+                        self.profile_files.append(base + "_memoria.txt")
+                        if profiler is not None:
+                            profiler.dump_stats(base + ".prof")
+                            self.profile_files.append(base + ".prof")
+                finally:
+                    _profiling_lock.release()
+            record.update({"segundos": round(elapsed, 4), "linhas": info.get("linhas"),
+                           "bytes": info.get("bytes"), "pico_etapa_mb": sampler.stop()})
+            self.stages.append(record)
+            logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+    def to_frame(self):
+        return pd.DataFrame(self.stages)